@@ -1,12 +1,27 @@
-﻿import streamlit as st
+﻿import time
+_INICIO_EXECUCAO = time.perf_counter()  # Marco zero do relatório de inicialização
+
+import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import warnings
 import datetime
 import logging
+import os
 import sys
 import json
+import hashlib
+import threading
+import unicodedata
+import urllib.request
+import bisect
+import tempfile
+from dataclasses import dataclass
 from io import BytesIO
+# plotly.express (gráficos), xlsxwriter (exportação) e pyarrow (modo compartilhado) são
+# importados apenas nas seções que os utilizam, para não atrasar a primeira renderização.
+
+_TEMPO_IMPORTACOES = time.perf_counter() - _INICIO_EXECUCAO
 
 
 # --- CSS PARA REDUZIR ESPAÇAMENTO ENTRE LINHAS ---
@@ -45,13 +60,57 @@ def to_excel(df: pd.DataFrame):
     output = BytesIO()
     # Usamos o Pandas ExcelWriter para criar o arquivo xlsx
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        # AQUI VOCÊ EXPORTA O DATAFRAME COM DADOS NUMÉRICOS (df_final_raw)
+        # AQUI VOCÊ EXPORTA O DATAFRAME COM DADOS NUMÉRICOS (sem formatar como texto)
         df.to_excel(writer, index=False, sheet_name='Análise de Queda')
+        # O separador de milhar/decimal fica a cargo do Excel (conforme o idioma do usuário)
+        formatar_colunas_numericas_excel(writer, 'Análise de Queda', df)
     
     # Retorna o arquivo binário
     return output.getvalue()
 
 
+def formatar_colunas_numericas_excel(writer, nome_aba, df: pd.DataFrame):
+    """Aplica o formato numérico '#,##0.00' às colunas numéricas de uma aba já gravada."""
+    aba = writer.sheets[nome_aba]
+    formato = writer.book.add_format({'num_format': '#,##0.00'})
+    for posicao, col in enumerate(df.columns):
+        if pd.api.types.is_numeric_dtype(df[col]):
+            aba.set_column(posicao, posicao, 18, formato)
+
+
+# --- Formatação pt-BR (R$ 1.234,56) ---
+# Troca ',' <-> '.' em uma única passada sobre o texto já formatado no padrão en-US
+_SEPARADORES_BR = str.maketrans(',.', '.,')
+
+
+def formatar_br(valor, is_currency=True):
+    """Formata um único valor em pt-BR (usado nos KPIs)."""
+    try:
+        texto = f"{valor:,.2f}".translate(_SEPARADORES_BR)
+    except (TypeError, ValueError):
+        return f"{valor}"
+    return f"R$ {texto}" if is_currency else texto
+
+
+def formatar_br_serie(valores: pd.Series, prefixo=''):
+    """
+    Formata uma coluna numérica inteira em pt-BR de uma vez, sem lambda por célula.
+    Retorna uma Series de textos com o mesmo índice; a coluna numérica original é mantida
+    pelo chamador para ordenação e exportação.
+    """
+    formatar = '{:,.2f}'.format
+    textos = [
+        prefixo + formatar(valor).translate(_SEPARADORES_BR)
+        for valor in valores.astype(float).tolist()
+    ]
+    return pd.Series(textos, index=valores.index, dtype=object)
+
+
+# Para tabelas exibidas com st.dataframe os números são enviados crus e formatados no
+# navegador (separadores do idioma do usuário), preservando a ordenação numérica.
+FORMATO_NUMERO_TABELA = st.column_config.NumberColumn(format='localized')
+
+
 OBS_FILE = 'observacoes_clientes.json'
 
 #Arquivo de observações dos clientes
@@ -77,7 +136,6 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger(__name__)
-logger.info(f"Usuario ativo {st.context.ip_address}")
 
 # Ignorar avisos que podem poluir o dashboard
 warnings.filterwarnings('ignore')
@@ -91,108 +149,1040 @@ st.set_page_config(
 
 st.title("📊 Dashboard de Vendas")
 
-# --- Função de Carregamento de Dados (com Cache e Limpeza) ---
-#@st.cache_data
-@st.cache_resource
-def carregar_dados(caminho_arquivo):
+# Nomes dos meses em português (índice 0 = janeiro), independentes do locale do servidor
+MESES_PT = [
+    'janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
+    'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro'
+]
+
+
+# --- Derivação sobre valores distintos ---
+def replicar_por_codigos(valores_unicos, codigos, index):
+    """
+    Replica `valores_unicos` (um valor por código) para todas as linhas.
+    Código -1 (valor ausente no pd.factorize) vira nulo.
+    """
+    return pd.Series(valores_unicos.array.take(codigos, allow_fill=True), index=index)
+
+
+def derivar_por_unicos(serie, transformacao):
+    """
+    Aplica `transformacao` (que recebe e devolve uma Series) apenas sobre os valores
+    distintos de `serie` e replica o resultado para todas as linhas.
+    """
+    codigos, unicos = pd.factorize(serie)
+    return replicar_por_codigos(transformacao(pd.Series(unicos)), codigos, serie.index)
+
+
+# --- Função de Carregamento de Dados (em Lotes e com Limpeza) ---
+# O arquivo é lido em lotes de LINHAS_POR_LOTE linhas: cada lote é limpo e tipado e suas
+# colunas vão para um buffer colunar. Assim o pico de memória é o DataFrame final mais um
+# lote, em vez de várias cópias do arquivo inteiro (texto bruto, colunas object e os
+# temporários da limpeza). Reduza DASHBOARD_LINHAS_POR_LOTE para limitar ainda mais o pico.
+# Não há cache aqui: o fingerprint no registro (carregar_da_fonte) já garante que o mesmo
+# conteúdo nunca é processado duas vezes.
+LINHAS_POR_LOTE = int(os.environ.get('DASHBOARD_LINHAS_POR_LOTE', 250_000))
+
+
+def limpar_lote(df):
+    """
+    Trata a formatação de números e processa o campo 'MESANO' de um lote do CSV para gerar
+    as colunas temporais necessárias. Retorna None se o arquivo não tiver a estrutura esperada.
+    """
+    # 1. LIMPEZA DE COLUNAS: Remove espaços em branco dos nomes das colunas
+    df.columns = df.columns.str.strip() 
+
+    # --- Tratamento de Colunas Numéricas ---
+    colunas_numericas = ['FATURA_KG', 'FATURA_RS', 'PRECO_MEDIO', 'BONIF_KG']
+    
+    for col in colunas_numericas:
+        if col in df.columns:
+            # Trata formato brasileiro (milhar: ponto, decimal: vírgula)
+            df[col] = df[col].astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        else:
+            st.warning(f"A coluna '{col}' não foi encontrada no arquivo. Verifique o cabeçalho.")
+            logger.warning(f"Carga abortada: coluna '{col}' ausente no arquivo")
+            return None 
+    
+    # --- NOVO: Tratamento de MESANO (11/2025) ---
+    if 'MESANO' not in df.columns:
+        # Caso o arquivo ainda tenha a estrutura antiga (MÊS e ANO), use a lógica anterior
+        if 'MÊS' in df.columns and 'ANO' in df.columns:
+             st.warning("Usando a estrutura antiga (MÊS/ANO). Verifique se o campo 'MESANO' foi adicionado corretamente.")
+             logger.warning("Arquivo sem o campo 'MESANO': usando a estrutura antiga (MÊS/ANO)")
+        else:
+            st.error("O arquivo não contém o campo 'MESANO', 'MÊS', ou 'ANO'. O processamento de datas não pode continuar.")
+            logger.error("Carga abortada: o arquivo não contém o campo 'MESANO', 'MÊS' ou 'ANO'")
+            return None
+    
+    # As colunas derivadas abaixo têm poucos valores distintos (dezenas de meses,
+    # algumas centenas de nomes) repetidos em milhões de linhas. Por isso cada
+    # transformação é feita UMA vez por valor distinto e replicada pelos códigos.
+
+    # 1. Converte MESANO para o formato de data (DD/MM/AAAA -> 01/MM/AAAA)
+    # O formato de entrada é MM/YYYY, então forçamos o dia '01/'
+    codigos_mesano, mesanos = pd.factorize(df['MESANO'])
+    datas = pd.Series(pd.to_datetime('01/' + pd.Series(mesanos), format='%d/%m/%Y', errors='coerce'))
+
+    # 2. Cria as colunas MÊS e ANO a partir da data para os filtros (em português,
+    # sem depender do locale do processo)
+    anos = datas.dt.year.astype('Int64').astype(str).where(datas.notna())
+    meses = datas.dt.month.map(dict(enumerate(MESES_PT, start=1)))
+
+    df['DATA_REF'] = replicar_por_codigos(datas, codigos_mesano, df.index)
+    df['ANO'] = replicar_por_codigos(anos, codigos_mesano, df.index)
+    df['MÊS'] = replicar_por_codigos(meses, codigos_mesano, df.index)
+
+    # --- Tratamento de Texto (Limpeza de espaços) ---
+    for col in ['FAMILIA', 'UF', 'COORDENADOR', 'REPRESENTANTE']:
+        df[col] = derivar_por_unicos(df[col], lambda unicos: unicos.str.strip())
+
+    # Remove linhas que falharam na conversão de data ou que têm valores nulos essenciais
+    return df.dropna(subset=['DATA_REF', 'FATURA_RS', 'FATURA_KG'])
+
+
+def juntar_lotes(buffer):
+    """
+    Monta o DataFrame final a partir do buffer colunar ({coluna: [Series de cada lote]}),
+    uma coluna por vez e já na ordem física por COORDENADOR e DATA_REF (ordenação estável):
+    cada par (COORDENADOR, ANO) vira uma faixa contígua do DataFrame, já em ordem de data.
+    Quem filtra por coordenador ou por período lê apenas as faixas selecionadas (ver
+    particoes_dados). Os pedaços de cada coluna são liberados assim que ela é montada.
+    """
+    def concatenar(col):
+        return pd.concat(buffer.pop(col), ignore_index=True)
+
+    colunas = {col: None for col in buffer}  # Preserva a ordem original das colunas
+    colunas['DATA_REF'] = concatenar('DATA_REF')
+    colunas['COORDENADOR'] = concatenar('COORDENADOR')
+    ordem = np.lexsort((
+        pd.factorize(colunas['DATA_REF'], sort=True)[0],
+        pd.factorize(colunas['COORDENADOR'], sort=True)[0],
+    ))
+    for col in colunas:
+        serie = colunas[col] if colunas[col] is not None else concatenar(col)
+        colunas[col] = serie.take(ordem).reset_index(drop=True)
+    return pd.DataFrame(colunas, copy=False)
+
+
+def carregar_dados(arquivo_local, ao_progredir=None):
     """
-    Carrega o arquivo CSV, trata a formatação de números e processa o novo campo 'MESANO' 
-    para gerar as colunas temporais necessárias.
+    Lê o CSV em lotes, limpa cada lote e monta o DataFrame final. `ao_progredir`, se
+    informado, é chamado após cada lote com (fração do arquivo lida, linhas lidas).
     """
     try:
-        # Tenta ler o CSV (mantendo o delimiter=',' como você usou)
-        #df = pd.read_csv(caminho_arquivo, delimiter=',') 
-        df = pd.read_csv(caminho_arquivo, sep=',') #Para tenttar ler o arquivo no googledrive
-        
-        # 1. LIMPEZA DE COLUNAS: Remove espaços em branco dos nomes das colunas
-        df.columns = df.columns.str.strip() 
-
-        # 2. VERIFICAÇÃO INICIAL
-        if df.empty:
+        tamanho = max(os.path.getsize(arquivo_local), 1)
+        buffer = {}
+        linhas_lidas = 0
+        with open(arquivo_local, 'rb') as f:
+            # Tenta ler o CSV (mantendo o delimiter=',' como você usou)
+            for lote in pd.read_csv(f, sep=',', chunksize=LINHAS_POR_LOTE):
+                linhas_lidas += len(lote)
+                lote = limpar_lote(lote)
+                if lote is None:
+                    return None
+                # Cópia por coluna: o bloco do lote é liberado em seguida
+                for col in lote.columns:
+                    buffer.setdefault(col, []).append(lote[col].copy())
+                del lote
+                if ao_progredir is not None:
+                    ao_progredir(min(f.tell() / tamanho, 1.0), linhas_lidas)
+
+        # VERIFICAÇÃO INICIAL
+        if linhas_lidas == 0:
             st.error("O arquivo CSV foi lido, mas não contém dados.")
+            logger.error("Carga abortada: o arquivo CSV não contém dados")
             return None
 
-        # --- Tratamento de Colunas Numéricas ---
-        colunas_numericas = ['FATURA_KG', 'FATURA_RS', 'PRECO_MEDIO', 'BONIF_KG']
-        
-        for col in colunas_numericas:
-            if col in df.columns:
-                # Trata formato brasileiro (milhar: ponto, decimal: vírgula)
-                df[col] = df[col].astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            else:
-                st.warning(f"A coluna '{col}' não foi encontrada no arquivo. Verifique o cabeçalho.")
-                return None 
-        
-        # --- NOVO: Tratamento de MESANO (11/2025) ---
-        if 'MESANO' not in df.columns:
-            # Caso o arquivo ainda tenha a estrutura antiga (MÊS e ANO), use a lógica anterior
-            if 'MÊS' in df.columns and 'ANO' in df.columns:
-                 st.warning("Usando a estrutura antiga (MÊS/ANO). Verifique se o campo 'MESANO' foi adicionado corretamente.")
-            else:
-                st.error("O arquivo não contém o campo 'MESANO', 'MÊS', ou 'ANO'. O processamento de datas não pode continuar.")
-                return None
-        
-        # 1. Converte MESANO para o formato de data (DD/MM/AAAA -> 01/MM/AAAA)
-        # O formato de entrada é MM/YYYY, então forçamos o dia '01/'
-        df['DATA_REF'] = pd.to_datetime('01/' + df['MESANO'], format='%d/%m/%Y', errors='coerce')
-
-        # 2. Cria as colunas MÊS e ANO a partir do DATA_REF para os filtros (em português)
-        df['ANO'] = df['DATA_REF'].dt.strftime('%Y')
-        df['MÊS'] = df['DATA_REF'].dt.strftime('%B').str.lower().str.strip()
-
-        # Dicionário para garantir que os nomes dos meses estejam em português
-        traducao_mes = {
-            'january': 'janeiro', 'february': 'fevereiro', 'march': 'março', 
-            'april': 'abril', 'may': 'maio', 'june': 'junho',
-            'july': 'julho', 'august': 'agosto', 'september': 'setembro', 
-            'october': 'outubro', 'november': 'novembro', 'december': 'dezembro'
-        }
-        df['MÊS'] = df['MÊS'].replace(traducao_mes, regex=True)
-
-        # --- Tratamento de Texto (Limpeza de espaços) ---
-        # Não precisamos mais do df['MÊS'].str.strip() pois foi recriado
-        df['FAMILIA'] = df['FAMILIA'].str.strip()
-        df['UF'] = df['UF'].str.strip()
-        df['COORDENADOR'] = df['COORDENADOR'].str.strip()
-        df['REPRESENTANTE'] = df['REPRESENTANTE'].str.strip() 
-
-        # Remove linhas que falharam na conversão de data ou que têm valores nulos essenciais
-        df = df.dropna(subset=['DATA_REF', 'FATURA_RS', 'FATURA_KG'])
-        
-        return df
+        return juntar_lotes(buffer)
     
+    except Exception as e:
+        st.error(f"Ocorreu um erro inesperado durante o processamento de dados: {e}")
+        logger.error(f"Falha ao processar os dados: {e}", exc_info=True)
+        return None
+
+
+# --- Versionamento dos Dados (Fingerprint do Conteúdo) ---
+@dataclass
+class BaseDados:
+    """Uma versão carregada dos dados: o DataFrame limpo e sua identificação."""
+    df: pd.DataFrame
+    versao: str  # Fingerprint (hash BLAKE2b) dos bytes brutos do arquivo
+    carregado_em: datetime.datetime
+    tempo_carga: float  # Segundos gastos baixando e processando (ou restaurando)
+    origem: str = 'fonte'  # 'fonte' (arquivo/URL) ou 'snapshot' (cópia local em disco)
+
+
+TAMANHO_BLOCO_LEITURA = 1 << 20  # Bytes lidos por vez ao baixar/calcular o fingerprint
+
+
+def ler_fonte(caminho_arquivo):
+    """
+    Prepara a fonte para a leitura em lotes e calcula seu fingerprint sem carregá-la inteira
+    na memória. Retorna (arquivo_local, versao, temporario): uma URL (Google Drive) é baixada
+    em blocos para um arquivo temporário, que o chamador deve apagar.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    if caminho_arquivo.startswith(('http://', 'https://')):
+        destino = tempfile.NamedTemporaryFile(prefix='dashboard_', suffix='.csv', delete=False)
+        try:
+            with destino, urllib.request.urlopen(caminho_arquivo, timeout=120) as resposta:
+                while bloco := resposta.read(TAMANHO_BLOCO_LEITURA):
+                    fingerprint.update(bloco)
+                    destino.write(bloco)
+        except BaseException:
+            os.remove(destino.name)
+            raise
+        return destino.name, fingerprint.hexdigest(), True
+
+    with open(caminho_arquivo, 'rb') as f:
+        while bloco := f.read(TAMANHO_BLOCO_LEITURA):
+            fingerprint.update(bloco)
+    return caminho_arquivo, fingerprint.hexdigest(), False
+
+
+# Versões substituídas que continuam consultáveis: sessões no meio de uma execução, relatórios
+# em andamento e o pré-aquecimento ainda podem pedir a versão anterior após uma atualização.
+# Os caches por versão (max_entries=2) guardam a atual e mais esta.
+VERSOES_ANTERIORES = 1
+
+
+@st.cache_resource
+def registro_dados():
+    """
+    Registro compartilhado por todas as sessões com a versão ATUAL dos dados de cada
+    arquivo ({caminho: BaseDados}), as últimas versões substituídas e um lock para que duas
+    sessões não baixem ao mesmo tempo.
+    """
+    return {'versoes': {}, 'anteriores': [], 'lock': threading.Lock()}
+
+
+# --- Snapshot Local (Partida a Quente) ---
+# Cada versão carregada da fonte é gravada em disco no formato Arrow/Feather. Ao reiniciar
+# o servidor, a primeira sessão restaura o snapshot (leitura local, sem download nem
+# limpeza) e a fonte é consultada em segundo plano.
+SNAPSHOT_DIR = os.environ.get('DASHBOARD_SNAPSHOT_DIR', 'snapshot_dados')
+
+
+def _caminho_snapshot(caminho_arquivo):
+    """Arquivos (.arrow e .json) do snapshot de uma fonte de dados."""
+    nome = hashlib.blake2b(caminho_arquivo.encode('utf-8'), digest_size=8).hexdigest()
+    base = os.path.join(SNAPSHOT_DIR, f'snapshot_{nome}')
+    return base + '.arrow', base + '.json'
+
+
+def salvar_snapshot(caminho_arquivo, base):
+    """Grava a versão carregada em disco (de forma atômica). Falhas apenas geram log."""
+    arquivo_dados, arquivo_meta = _caminho_snapshot(caminho_arquivo)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        base.df.reset_index(drop=True).to_feather(arquivo_dados + '.tmp')
+        with open(arquivo_meta + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'versao': base.versao, 'carregado_em': base.carregado_em.isoformat()}, f)
+        # Dados primeiro, metadados depois: o .json só aponta para um .arrow completo
+        os.replace(arquivo_dados + '.tmp', arquivo_dados)
+        os.replace(arquivo_meta + '.tmp', arquivo_meta)
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar o snapshot dos dados: {e}")
+
+
+def restaurar_snapshot(caminho_arquivo):
+    """Restaura a última versão gravada em disco, ou retorna None se não houver."""
+    arquivo_dados, arquivo_meta = _caminho_snapshot(caminho_arquivo)
+    inicio = time.perf_counter()
+    try:
+        with open(arquivo_meta, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        df = pd.read_feather(arquivo_dados)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Snapshot dos dados ignorado (ilegível): {e}")
+        return None
+    return BaseDados(
+        df=df,
+        versao=meta['versao'],
+        carregado_em=datetime.datetime.fromisoformat(meta['carregado_em']),
+        tempo_carga=time.perf_counter() - inicio,
+        origem='snapshot',
+    )
+
+
+def carregar_da_fonte(caminho_arquivo, atual):
+    """
+    Lê a fonte, calcula o fingerprint e processa os dados se o conteúdo for novo.
+    Retorna (base, situacao): ('nova' com a nova BaseDados), ('inalterada' com `atual`, se o
+    fingerprint é o mesmo) ou ('erro' com `atual`, se a fonte não pôde ser lida ou processada).
+    """
+    inicio = time.perf_counter()
+    try:
+        arquivo_local, versao, temporario = ler_fonte(caminho_arquivo)
     except FileNotFoundError:
         st.error(f"Erro: O arquivo '{caminho_arquivo}' não foi encontrado.")
         st.info("Por favor, certifique-se de que o arquivo .csv está na mesma pasta que o script Python.")
-        return None
+        logger.error(f"Fonte de dados não encontrada: {caminho_arquivo}")
+        return atual, 'erro'
     except Exception as e:
-        st.error(f"Ocorreu um erro inesperado durante o processamento de dados: {e}")
+        st.error(f"Ocorreu um erro inesperado ao ler os dados: {e}")
+        logger.error(f"Falha ao ler a fonte de dados {caminho_arquivo}: {e}")
+        return atual, 'erro'
+
+    try:
+        if atual is not None and atual.versao == versao:
+            logger.info(f"Recarga sem alterações (versão {versao[:8]})")
+            return atual, 'inalterada'
+
+        barra = st.progress(0.0, text="Carregando dados...")
+
+        def ao_progredir(fracao, linhas):
+            barra.progress(fracao, text=f"Carregando dados... {linhas:,} linhas lidas".replace(',', '.'))
+            logger.info(f"Carga da versão {versao[:8]}: {fracao:.0%} do arquivo, {linhas} linhas")
+
+        df = carregar_dados(arquivo_local, ao_progredir)
+        barra.empty()
+    finally:
+        if temporario:
+            os.remove(arquivo_local)
+
+    if df is None or df.empty:
+        # Na atualização em segundo plano (sem sessão) as mensagens st.* não aparecem: só o log
+        logger.warning(
+            f"Versão {versao[:8]} descartada (sem dados válidos); "
+            f"mantendo {'a versão ' + atual.versao[:8] if atual is not None else 'nenhuma versão'}"
+        )
+        return atual, 'erro'
+
+    return BaseDados(
+        df=df,
+        versao=versao,
+        carregado_em=datetime.datetime.now(),
+        tempo_carga=time.perf_counter() - inicio,
+    ), 'nova'
+
+
+def obter_base_dados(caminho_arquivo, recarregar=False):
+    """
+    Retorna a BaseDados atual do arquivo, carregando-a na primeira chamada.
+
+    Na primeira chamada do processo, um snapshot local é restaurado se existir e a
+    fonte é verificada em segundo plano. Com `recarregar=True` a fonte é lida novamente
+    e o fingerprint recalculado; se o conteúdo não mudou, nada é reprocessado e todos
+    os caches continuam válidos. Retorna None se os dados não puderem ser carregados.
+    """
+    return _obter_base_dados(caminho_arquivo, recarregar)[0]
+
+
+def recarregar_base_dados(caminho_arquivo):
+    """
+    Relê a fonte (como obter_base_dados com `recarregar=True`) e retorna (base, situacao),
+    onde situacao é 'nova', 'inalterada', 'erro' (a fonte falhou e `base` é a versão
+    anterior) ou 'ocupado' (outro processo já está recarregando, no modo compartilhado).
+    """
+    return _obter_base_dados(caminho_arquivo, recarregar=True)
+
+
+def _obter_base_dados(caminho_arquivo, recarregar):
+    """Implementação de obter_base_dados; retorna (base, situacao)."""
+    if DADOS_COMPARTILHADOS_DIR:
+        return obter_base_compartilhada(caminho_arquivo, recarregar)
+
+    registro = registro_dados()
+    atual = registro['versoes'].get(caminho_arquivo)
+    if atual is not None and not recarregar:
+        return atual, 'inalterada'
+
+    with registro['lock']:
+        # Outra sessão pode ter carregado os dados enquanto esperávamos o lock
+        atual = registro['versoes'].get(caminho_arquivo)
+        if atual is not None and not recarregar:
+            return atual, 'inalterada'
+
+        if atual is None and not recarregar:
+            restaurada = restaurar_snapshot(caminho_arquivo)
+            if restaurada is not None:
+                instalar_versao(caminho_arquivo, restaurada)
+                threading.Thread(
+                    target=obter_base_dados,
+                    args=(caminho_arquivo, True),
+                    name='atualizacao-dados',
+                    daemon=True,
+                ).start()
+                return restaurada, 'nova'
+
+        nova, situacao = carregar_da_fonte(caminho_arquivo, atual)
+        if situacao == 'nova':
+            instalar_versao(caminho_arquivo, nova)
+            salvar_snapshot(caminho_arquivo, nova)
+        return nova, situacao
+
+
+# --- Modo Compartilhado (vários processos do dashboard na mesma máquina) ---
+# Com DASHBOARD_DADOS_COMPARTILHADOS=<pasta>, apenas UM processo (o que obtiver o lock de
+# carga) baixa e limpa os dados e os publica num arquivo Arrow IPC nessa pasta. Todos os
+# processos (inclusive o carregador) mapeiam esse arquivo em memória, somente leitura e sem
+# cópia, de modo que o sistema operacional mantém uma única cópia dos dados na RAM. Os índices
+# que crescem com a base (fatias de clientes e esboços de preço) são publicados e mapeados da
+# mesma forma; os pequenos (partições e busca dos filtros) são montados em cada processo.
+# Uma versão nova é publicada trocando atomicamente o arquivo de ponteiro 'atual.json';
+# cada processo percebe a troca na execução seguinte de qualquer sessão.
+DADOS_COMPARTILHADOS_DIR = os.environ.get('DASHBOARD_DADOS_COMPARTILHADOS', '')
+ESPERA_MAX_CARGA = 600  # Segundos até um lock de carga ser considerado abandonado
+
+
+def _arquivo_compartilhado(nome):
+    return os.path.join(DADOS_COMPARTILHADOS_DIR, nome)
+
+
+def adquirir_lock_carga():
+    """Tenta se tornar o processo carregador. Retorna True se conseguiu o lock."""
+    caminho_lock = _arquivo_compartilhado('carga.lock')
+    os.makedirs(DADOS_COMPARTILHADOS_DIR, exist_ok=True)
+    try:
+        if time.time() - os.path.getmtime(caminho_lock) > ESPERA_MAX_CARGA:
+            os.remove(caminho_lock)  # Lock abandonado por um processo que morreu
+    except FileNotFoundError:
+        pass
+    try:
+        descritor = os.open(caminho_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(descritor, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def liberar_lock_carga():
+    try:
+        os.remove(_arquivo_compartilhado('carga.lock'))
+    except FileNotFoundError:
+        pass
+
+
+def ler_publicacao():
+    """Lê o ponteiro 'atual.json' (versão publicada), relendo-o apenas se o arquivo mudou."""
+    caminho_ponteiro = _arquivo_compartilhado('atual.json')
+    registro = registro_dados()
+    try:
+        modificado = os.stat(caminho_ponteiro).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    em_cache = registro.get('publicacao')
+    if em_cache is None or em_cache[0] != modificado:
+        with open(caminho_ponteiro, 'r', encoding='utf-8') as f:
+            registro['publicacao'] = (modificado, json.load(f))
+    return registro['publicacao'][1]
+
+
+def gravar_arrow(caminho, df):
+    """Grava `df` em Arrow IPC (sem compressão, para permitir o mapeamento), de forma atômica."""
+    import pyarrow as pa
+
+    colunas = {}
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_float_dtype(serie):
+            # from_pandas=False mantém NaN como NaN (e não nulo), permitindo leitura sem cópia
+            colunas[col] = pa.array(serie.to_numpy(), from_pandas=False)
+        else:
+            try:
+                colunas[col] = pa.Array.from_pandas(serie)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Colunas de texto com tipos misturados (ex.: códigos numéricos e alfanuméricos)
+                colunas[col] = pa.Array.from_pandas(serie.astype('str'))
+    tabela = pa.table(colunas)
+
+    with pa.OSFile(caminho + '.tmp', 'wb') as saida, pa.ipc.new_file(saida, tabela.schema) as escritor:
+        escritor.write_table(tabela)
+    os.replace(caminho + '.tmp', caminho)
+
+
+def mapear_arrow(caminho):
+    """Mapeia em memória um arquivo gravado por gravar_arrow e monta o DataFrame sem copiar os dados."""
+    import pyarrow as pa
+
+    tabela = pa.ipc.open_file(pa.memory_map(caminho, 'r')).read_all()
+    colunas = {}
+    for nome in tabela.column_names:
+        coluna = tabela.column(nome)
+        if pa.types.is_string(coluna.type) or pa.types.is_large_string(coluna.type):
+            # Texto: o array do pandas apenas "embrulha" a memória Arrow mapeada
+            colunas[nome] = pd.StringDtype('pyarrow', na_value=np.nan).__from_arrow__(coluna)
+        elif coluna.num_chunks == 1 and coluna.null_count == 0:
+            # Números e datas: visão numpy direta sobre o arquivo mapeado
+            colunas[nome] = coluna.chunk(0).to_numpy(zero_copy_only=True)
+        else:
+            colunas[nome] = coluna.to_pandas()
+    return pd.DataFrame(colunas, copy=False)
+
+
+def publicar_indices(base):
+    """
+    Grava os índices tabulares da versão (fatias de clientes e esboços de preço), que crescem
+    com a base, para que os demais processos os mapeiem em vez de recalculá-los. O manifesto
+    'indices_<versao>.json' é gravado por último e indica que todos os arquivos estão completos.
+    """
+    fatias = montar_fatias(base.df)
+    esbocos = montar_esbocos(base.df)
+    tabelas = {
+        'fatias': fatias['tabela'],
+        'fatias_clientes': pd.DataFrame({'CLIENTE': fatias['clientes']}),
+        'fatias_deslocamentos': pd.DataFrame({'DESLOCAMENTO': fatias['deslocamentos']}),
+        'esbocos_baldes': esbocos['baldes'],
+        'esbocos_totais': esbocos['totais'],
+    }
+    for nome, tabela in tabelas.items():
+        gravar_arrow(_arquivo_compartilhado(f'{nome}_{base.versao}.arrow'), tabela)
+
+    manifesto = _arquivo_compartilhado(f'indices_{base.versao}.json')
+    with open(manifesto + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'tabelas': list(tabelas), 'total_clientes': fatias['total_clientes']}, f)
+    os.replace(manifesto + '.tmp', manifesto)
+
+
+def indices_publicados(versao, nomes):
+    """
+    Mapeia os índices `nomes` publicados de uma versão ({nome: DataFrame} e 'total_clientes'),
+    ou retorna None fora do modo compartilhado ou se a versão não tiver índices publicados.
+    """
+    if not DADOS_COMPARTILHADOS_DIR:
+        return None
+    try:
+        with open(_arquivo_compartilhado(f'indices_{versao}.json'), 'r', encoding='utf-8') as f:
+            manifesto = json.load(f)
+        tabelas = {
+            nome: mapear_arrow(_arquivo_compartilhado(f'{nome}_{versao}.arrow'))
+            for nome in nomes
+        }
+    except FileNotFoundError:
+        return None
+    return {**tabelas, 'total_clientes': manifesto['total_clientes']}
+
+
+def publicar_versao(base):
+    """Grava a versão e seus índices em Arrow IPC e a publica trocando o ponteiro 'atual.json'."""
+    nome_dados = f'dados_{base.versao}.arrow'
+    gravar_arrow(_arquivo_compartilhado(nome_dados), base.df)
+    publicar_indices(base)
+
+    ponteiro = {
+        'versao': base.versao,
+        'arquivo': nome_dados,
+        'carregado_em': base.carregado_em.isoformat(),
+        'tempo_carga': base.tempo_carga,
+    }
+    with open(_arquivo_compartilhado('atual.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(ponteiro, f)
+    os.replace(_arquivo_compartilhado('atual.json.tmp'), _arquivo_compartilhado('atual.json'))
+
+    # Remove versões antigas (exceto a anterior), com seus índices. Processos que ainda as
+    # mapeiam continuam lendo normalmente: no Linux o conteúdo só é liberado quando o último
+    # mapeamento fecha.
+    arquivos = os.listdir(DADOS_COMPARTILHADOS_DIR)
+    versoes = sorted(
+        (n for n in arquivos if n.startswith('dados_') and n.endswith('.arrow')),
+        key=lambda n: os.path.getmtime(_arquivo_compartilhado(n)),
+    )
+    for antigo in versoes[:-2]:
+        versao_antiga = antigo[len('dados_'):-len('.arrow')]
+        for nome in arquivos:
+            if nome.endswith(f'_{versao_antiga}.arrow') or nome == f'indices_{versao_antiga}.json':
+                try:
+                    os.remove(_arquivo_compartilhado(nome))
+                except OSError:
+                    pass
+    return ponteiro
+
+
+def mapear_publicacao(ponteiro):
+    """Mapeia em memória o arquivo publicado e monta o DataFrame sem copiar os dados."""
+    inicio = time.perf_counter()
+    df = mapear_arrow(_arquivo_compartilhado(ponteiro['arquivo']))
+    return BaseDados(
+        df=df,
+        versao=ponteiro['versao'],
+        carregado_em=datetime.datetime.fromisoformat(ponteiro['carregado_em']),
+        tempo_carga=time.perf_counter() - inicio,
+        origem='compartilhado',
+    )
+
+
+def obter_base_compartilhada(caminho_arquivo, recarregar=False):
+    """Versão de _obter_base_dados para o modo compartilhado entre processos; retorna (base, situacao)."""
+    registro = registro_dados()
+    atual = registro['versoes'].get(caminho_arquivo)
+    publicada = ler_publicacao()
+
+    if publicada is not None and not recarregar:
+        if atual is None or atual.versao != publicada['versao']:
+            with registro['lock']:
+                atual = registro['versoes'].get(caminho_arquivo)
+                if atual is None or atual.versao != publicada['versao']:
+                    atual = mapear_publicacao(publicada)
+                    instalar_versao(caminho_arquivo, atual)
+                    return atual, 'nova'
+        return atual, 'inalterada'
+
+    if not adquirir_lock_carga():
+        if recarregar and atual is not None:
+            return atual, 'ocupado'  # Outro processo já está recarregando
+        # Outro processo está fazendo a primeira carga: aguarda a publicação
+        limite = time.time() + ESPERA_MAX_CARGA
+        while publicada is None and time.time() < limite:
+            time.sleep(1)
+            publicada = ler_publicacao()
+        return obter_base_compartilhada(caminho_arquivo) if publicada is not None else (None, 'ocupado')
+
+    try:
+        with registro['lock']:
+            nova, situacao = carregar_da_fonte(caminho_arquivo, atual)
+            if situacao != 'nova':
+                return atual, situacao
+            publicada = publicar_versao(nova)
+            # O DataFrame recém-processado é descartado: este processo também passa a usar
+            # a cópia mapeada, como todos os outros
+            mapeada = mapear_publicacao(publicada)
+            mapeada.tempo_carga = nova.tempo_carga
+            instalar_versao(caminho_arquivo, mapeada)
+            return mapeada, 'nova'
+    finally:
+        liberar_lock_carga()
+
+
+def instalar_versao(caminho_arquivo, base):
+    """Torna `base` a versão atual do arquivo e prepara seus índices."""
+    registro = registro_dados()
+    substituida = registro['versoes'].get(caminho_arquivo)
+    if substituida is not None and substituida.versao != base.versao:
+        registro['anteriores'] = ([substituida] + registro['anteriores'])[:VERSOES_ANTERIORES]
+    registro['versoes'][caminho_arquivo] = base
+    inicio = time.perf_counter()
+    preparar_indices(base.versao)
+    tempo_indices = time.perf_counter() - inicio
+    registrar_marco('carga_dados', base.tempo_carga)
+    registrar_marco('indices', tempo_indices)
+    logger.info(
+        f"Dados carregados ({base.origem}): versão {base.versao[:8]}, {len(base.df)} linhas "
+        f"em {base.tempo_carga:.2f}s; índices em {tempo_indices:.2f}s"
+    )
+
+
+def df_da_versao(versao):
+    """Retorna o DataFrame de uma versão registrada, atual ou anterior (usado pelos caches derivados)."""
+    registro = registro_dados()
+    for base in [*registro['versoes'].values(), *registro['anteriores']]:
+        if base.versao == versao:
+            return base.df
+    raise KeyError(f"Versão de dados desconhecida: {versao}")
+
+
+# --- Dicionário de meses para ordenação correta (fora da função)
+mes_map_ordem = {mes: numero for numero, mes in enumerate(MESES_PT, start=1)}
+
+
+# --- Opções de cada filtro (índice de valores distintos, calculado uma vez por versão) ---
+@st.cache_data(max_entries=32)
+def opcoes_filtro(versao, key_col, mes_ordenacao=False):
+    """Retorna os valores distintos e ordenados de uma coluna para a versão dos dados."""
+    opcoes_disponiveis = df_da_versao(versao)[key_col].unique().tolist()
+
+    if mes_ordenacao:
+        return sorted(opcoes_disponiveis, key=lambda m: mes_map_ordem.get(m.lower().strip(), 0))
+    return sorted(opcoes_disponiveis)
+
+
+# --- Índice de busca para filtros de alta cardinalidade (Cliente e Produto) ---
+LIMITE_BUSCA = 50
+
+
+def normalizar_busca(texto):
+    """Normaliza o texto para busca: sem acentos, minúsculo e sem espaços nas pontas."""
+    sem_acentos = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(c for c in sem_acentos if not unicodedata.combining(c)).casefold().strip()
+
+
+@st.cache_resource(max_entries=8)
+def rotulos_busca(versao, key_col):
+    """
+    Texto exibido/pesquisável de cada opção (para PRODUTO inclui a DESCRICAO). O dicionário é
+    compartilhado (sem cópia a cada execução), portanto NÃO deve ser alterado por quem o consome.
+    """
+    df_versao = df_da_versao(versao)
+    if key_col == 'PRODUTO' and 'DESCRICAO' in df_versao.columns:
+        produtos = df_versao[['PRODUTO', 'DESCRICAO']].drop_duplicates(subset=['PRODUTO'])
+        return dict(zip(produtos['PRODUTO'], produtos['PRODUTO'] + ' - ' + produtos['DESCRICAO'].astype(str)))
+    return {valor: str(valor) for valor in opcoes_filtro(versao, key_col)}
+
+
+@st.cache_resource(max_entries=8)
+def indice_busca(versao, key_col):
+    """
+    Índice de busca de uma coluna: lista ordenada de prefixos (para termos curtos) e
+    índice de trigramas (para busca por trecho em qualquer posição do texto).
+    """
+    valores = opcoes_filtro(versao, key_col)
+    rotulos = rotulos_busca(versao, key_col)
+    normalizados = [normalizar_busca(rotulos.get(valor, valor)) for valor in valores]
+
+    prefixos = sorted((texto, i) for i, texto in enumerate(normalizados))
+    trigramas = {}
+    for i, texto in enumerate(normalizados):
+        for j in range(len(texto) - 2):
+            trigramas.setdefault(texto[j:j + 3], set()).add(i)
+
+    return {
+        'valores': valores,
+        'normalizados': normalizados,
+        'chaves_prefixo': [texto for texto, _ in prefixos],
+        'ids_prefixo': [i for _, i in prefixos],
+        'trigramas': trigramas,
+    }
+
+
+def buscar_opcoes(versao, key_col, termo, limite=LIMITE_BUSCA):
+    """Retorna até `limite` valores da coluna cujo texto contém `termo`."""
+    indice = indice_busca(versao, key_col)
+    termo = normalizar_busca(termo)
+
+    if len(termo) < 3:
+        # Termos curtos: busca por prefixo (bisect na lista ordenada)
+        chaves = indice['chaves_prefixo']
+        inicio = bisect.bisect_left(chaves, termo)
+        ids = []
+        for pos in range(inicio, len(chaves)):
+            if not chaves[pos].startswith(termo) or len(ids) >= limite:
+                break
+            ids.append(indice['ids_prefixo'][pos])
+        ids.sort()
+    else:
+        # Termos longos: interseção das listas de cada trigrama, depois confirmação do trecho
+        listas = [indice['trigramas'].get(termo[j:j + 3], set()) for j in range(len(termo) - 2)]
+        candidatos = set.intersection(*sorted(listas, key=len))
+        ids = sorted(i for i in candidatos if termo in indice['normalizados'][i])[:limite]
+
+    return [indice['valores'][i] for i in ids]
+
+
+# --- Partições por COORDENADOR/ANO e índice temporal ---
+# Os dados são carregados ordenados por COORDENADOR e DATA_REF, então cada par (COORDENADOR,
+# ANO) ocupa uma faixa contígua de linhas, ordenada por data. Os filtros dessas colunas e o
+# intervalo de período são resolvidos primeiro, escolhendo só as faixas compatíveis (poda de
+# partições) e recortando cada uma por busca binária na data; os demais filtros rodam sobre
+# esse recorte.
+COLUNAS_PARTICAO = ['COORDENADOR', 'ANO', 'DATA_REF']
+
+
+@st.cache_resource(max_entries=2)
+def particoes_dados(versao):
+    """
+    Mapeia cada par (COORDENADOR, ANO) às fatias de linhas que ele ocupa no DataFrame e indica
+    se as datas estão em ordem dentro de cada fatia (condição para a busca binária por período).
+    """
+    df = df_da_versao(versao)
+    codigos_coord, coordenadores = pd.factorize(df['COORDENADOR'])
+    codigos_ano, anos = pd.factorize(df['ANO'])
+    datas = df['DATA_REF'].to_numpy()
+    if len(df) == 0:
+        return {'fatias': {}, 'datas_ordenadas': True}
+
+    # Início de cada faixa: onde o coordenador ou o ano muda em relação à linha anterior.
+    # Numa base fora de ordem (ex.: snapshot antigo) a mesma chave apenas aparece em mais fatias.
+    muda = (codigos_coord[1:] != codigos_coord[:-1]) | (codigos_ano[1:] != codigos_ano[:-1])
+    mudancas = np.flatnonzero(muda) + 1
+    inicios = np.concatenate(([0], mudancas))
+    fins = np.concatenate((mudancas, [len(df)]))
+
+    fatias = {}
+    for inicio, fim in zip(inicios.tolist(), fins.tolist()):
+        chave = (
+            coordenadores[codigos_coord[inicio]] if codigos_coord[inicio] >= 0 else None,
+            anos[codigos_ano[inicio]] if codigos_ano[inicio] >= 0 else None,
+        )
+        fatias.setdefault(chave, []).append(slice(inicio, fim))
+    return {
+        'fatias': fatias,
+        'datas_ordenadas': bool(np.all(muda | (datas[1:] >= datas[:-1]))),
+    }
+
+
+def recortar_periodo(datas, fatia, inicio, fim):
+    """Restringe uma fatia (ordenada por data) às linhas com data entre inicio e fim, por busca binária."""
+    trecho = datas[fatia]
+    primeira = fatia.start + int(np.searchsorted(trecho, inicio, side='left'))
+    ultima = fatia.start + int(np.searchsorted(trecho, fim, side='right'))
+    return slice(primeira, ultima) if ultima > primeira else None
+
+
+def unir_fatias(fatias):
+    """Junta fatias consecutivas (ordenadas pelo início) que se encostam, ex.: 0:10 e 10:25 viram 0:25."""
+    unidas = []
+    for fatia in fatias:
+        if unidas and unidas[-1].stop == fatia.start:
+            unidas[-1] = slice(unidas[-1].start, fatia.stop)
+        else:
+            unidas.append(fatia)
+    return unidas
+
+
+@st.cache_resource(max_entries=4, ttl=600)
+def dados_particoes(versao, filtros_particao):
+    """
+    Recorte do DataFrame com apenas as partições compatíveis com os filtros de COORDENADOR/ANO,
+    limitadas ao período selecionado (se houver).
+    Depende só desses filtros, então é reaproveitado por todas as sessões do mesmo escopo,
+    quaisquer que sejam os demais filtros. Quando o recorte não é uma faixa contínua ele é uma
+    cópia, por isso o cache guarda poucas entradas.
+    """
+    df = df_da_versao(versao)
+    particoes = particoes_dados(versao)
+    permitidos = {col: set(valores) for col, modo, valores in filtros_particao if modo == 'incluir'}
+    fatias = [
+        fatia
+        for (coordenador, ano), lista in particoes['fatias'].items()
+        if coordenador in permitidos.get('COORDENADOR', (coordenador,))
+        and ano in permitidos.get('ANO', (ano,))
+        for fatia in lista
+    ]
+    fatias.sort(key=lambda fatia: fatia.start)
+
+    periodo = next((valores for col, modo, valores in filtros_particao if modo == 'intervalo'), None)
+    if periodo is not None:
+        inicio, fim = (pd.Timestamp(data).to_datetime64() for data in periodo)
+        datas = df['DATA_REF'].to_numpy()
+        if particoes['datas_ordenadas']:
+            fatias = [recortada for fatia in fatias if (recortada := recortar_periodo(datas, fatia, inicio, fim))]
+        else:
+            # Base fora de ordem (snapshot antigo): recorta cada fatia por máscara
+            fatias = [
+                posicoes
+                for fatia in fatias
+                if len(posicoes := fatia.start + np.flatnonzero((datas[fatia] >= inicio) & (datas[fatia] <= fim)))
+            ]
+            return df.take(np.concatenate(fatias)) if fatias else df.iloc[0:0]
+    # Partições vizinhas (ex.: todos os anos de um coordenador) formam uma faixa só
+    fatias = unir_fatias(fatias)
+    if len(fatias) == 1:
+        return df.iloc[fatias[0]]  # Uma única faixa: visão sem cópia
+    posicoes = np.concatenate([np.arange(f.start, f.stop) for f in fatias]) if fatias else np.array([], dtype=int)
+    return df.take(posicoes)
+
+
+# --- Esboços de Distribuição de Preços (PRECO_MEDIO) ---
+# Para cada (COORDENADOR, FAMILIA, PRODUTO, mês) guardamos um histograma dos preços das notas
+# em baldes logarítmicos: o balde i cobre os preços entre GAMA_ESBOCO^(i-1) e GAMA_ESBOCO^i,
+# então qualquer quantil é estimado com erro relativo de ~1% (a mesma ideia do DDSketch).
+# Os histogramas se somam: quantis, dispersão e outliers de qualquer conjunto de produtos e
+# meses saem da soma dos baldes, sem percorrer as linhas de nota. São montados junto com os
+# demais índices de cada versão e têm uma fração do tamanho da base.
+GAMA_ESBOCO = 1.02
+CHAVES_ESBOCO = ['COORDENADOR', 'FAMILIA', 'PRODUTO', 'DATA_REF']
+# Filtros que os esboços respondem sozinhos (ANO e MÊS derivam de DATA_REF). Com qualquer
+# outro filtro ativo os esboços são montados a partir das linhas filtradas.
+FILTROS_ESBOCO = {'COORDENADOR', 'FAMILIA', 'PRODUTO', 'ANO', 'MÊS', 'DATA_REF'}
+
+
+def valor_balde(baldes):
+    """Preço representativo de cada balde (o ponto de erro relativo mínimo do intervalo)."""
+    return 2 * GAMA_ESBOCO ** baldes / (GAMA_ESBOCO + 1)
+
+
+def montar_esbocos(df):
+    """
+    Monta os esboços de preço de `df`: um histograma de baldes (LINHAS por balde) e os totais
+    de R$ e Kg (para o preço médio ponderado), ambos por CHAVES_ESBOCO.
+    """
+    precos = df['PRECO_MEDIO'].to_numpy(dtype=float, na_value=np.nan)
+    validos = precos > 0
+    baldes = df.loc[validos, CHAVES_ESBOCO].assign(
+        BALDE=np.ceil(np.log(precos[validos]) / np.log(GAMA_ESBOCO)).astype('int32')
+    )
+    esbocos = {
+        'baldes': baldes.groupby(CHAVES_ESBOCO + ['BALDE'], sort=False, dropna=False).size().rename('LINHAS').reset_index(),
+        'totais': df.groupby(CHAVES_ESBOCO, sort=False, dropna=False)[['FATURA_RS', 'FATURA_KG']].sum().reset_index(),
+    }
+    for tabela in esbocos.values():
+        tabela['ANO'] = tabela['DATA_REF'].dt.year.astype('Int64').astype(str)
+        tabela['MÊS'] = tabela['DATA_REF'].dt.month.map(dict(enumerate(MESES_PT, start=1)))
+    return esbocos
+
+
+@st.cache_resource(max_entries=2)
+def esbocos_preco(versao):
+    """Esboços de preço da versão completa (sem filtros), mapeados se tiverem sido publicados."""
+    publicados = indices_publicados(versao, ['esbocos_baldes', 'esbocos_totais'])
+    if publicados is not None:
+        return {'baldes': publicados['esbocos_baldes'], 'totais': publicados['esbocos_totais']}
+    return montar_esbocos(df_da_versao(versao))
+
+
+# --- Fatias Pré-agregadas e Conjuntos de Clientes (KPIs sem varrer as linhas) ---
+# Para cada fatia (COORDENADOR, REPRESENTANTE, UF, FAMILIA, mês) guardamos as somas de R$,
+# Kg e bonificação e o conjunto dos códigos de cliente que compraram nela. Somas se somam,
+# mas contagens distintas não: os conjuntos ficam num único vetor de códigos ordenado por
+# fatia (com o deslocamento de cada fatia), e a união de qualquer seleção de fatias é feita
+# marcando um bitset com um bit por cliente. O resultado é exato, e o custo é proporcional
+# aos pares (fatia, cliente) selecionados, não às linhas de nota.
+CHAVES_FATIA = ['COORDENADOR', 'REPRESENTANTE', 'UF', 'FAMILIA', 'DATA_REF']
+# Filtros respondidos pelas fatias (ANO e MÊS derivam de DATA_REF). Com qualquer outro
+# filtro ativo (Cliente, Produto) os KPIs são calculados sobre as linhas filtradas.
+FILTROS_FATIA = set(CHAVES_FATIA) | {'ANO', 'MÊS'}
+
+
+def montar_fatias(df):
+    """Tabela de fatias de `df` com suas somas e o conjunto de clientes (códigos) de cada fatia."""
+    grupos = df.groupby(CHAVES_FATIA, sort=False, dropna=False)
+    tabela = grupos[['FATURA_RS', 'FATURA_KG', 'BONIF_KG']].sum().reset_index()
+    tabela['ANO'] = tabela['DATA_REF'].dt.year.astype('Int64').astype(str)
+    tabela['MÊS'] = tabela['DATA_REF'].dt.month.map(dict(enumerate(MESES_PT, start=1)))
+    codigos_mes, meses = pd.factorize(tabela['DATA_REF'], sort=True)
+    tabela['MES_CODIGO'] = codigos_mes
+
+    # Pares (fatia, cliente) distintos, ordenados por fatia (clientes nulos não contam,
+    # como no nunique)
+    codigos_fatia = grupos.ngroup().to_numpy()
+    codigos_cliente, clientes = pd.factorize(df['CLIENTE'])
+    validos = codigos_cliente >= 0
+    pares = np.unique(codigos_fatia[validos].astype('int64') * len(clientes) + codigos_cliente[validos])
+    fatia_do_par = pares // max(len(clientes), 1)
+    return {
+        'tabela': tabela,
+        'meses': meses,
+        'clientes': (pares % max(len(clientes), 1)).astype('int32'),
+        'deslocamentos': np.searchsorted(fatia_do_par, np.arange(len(tabela) + 1)),
+        'total_clientes': len(clientes),
+    }
+
+
+@st.cache_resource(max_entries=2)
+def fatias_clientes(versao):
+    """Fatias da versão (ver montar_fatias), mapeadas dos índices publicados se existirem."""
+    publicados = indices_publicados(versao, ['fatias', 'fatias_clientes', 'fatias_deslocamentos'])
+    if publicados is None:
+        return montar_fatias(df_da_versao(versao))
+    tabela = publicados['fatias']
+    return {
+        'tabela': tabela,
+        'meses': pd.factorize(tabela['DATA_REF'], sort=True)[1],
+        'clientes': publicados['fatias_clientes']['CLIENTE'].to_numpy(),
+        'deslocamentos': publicados['fatias_deslocamentos']['DESLOCAMENTO'].to_numpy(),
+        'total_clientes': publicados['total_clientes'],
+    }
+
+
+def fatias_selecionadas(versao, filtros):
+    """Fatias que atendem aos filtros, ou None se algum filtro não puder ser respondido por elas."""
+    if any(modo != 'todos' for col, modo, _ in filtros if col not in FILTROS_FATIA):
         return None
+    tabela = fatias_clientes(versao)['tabela']
+    return tabela[mascara_filtros(tabela, filtros)]
+
+
+def clientes_das_fatias(versao, fatias):
+    """Códigos de cliente (com repetição entre fatias) e a posição de cada fatia de origem."""
+    estrutura = fatias_clientes(versao)
+    posicoes = fatias.index.to_numpy()
+    inicios = estrutura['deslocamentos'][posicoes]
+    tamanhos = estrutura['deslocamentos'][posicoes + 1] - inicios
+    # Concatena os intervalos [inicio, inicio + tamanho) de todas as fatias sem laço Python
+    indices = np.repeat(inicios - np.cumsum(tamanhos) + tamanhos, tamanhos) + np.arange(tamanhos.sum())
+    return estrutura['clientes'][indices], np.repeat(np.arange(len(posicoes)), tamanhos)
+
+
+def contar_clientes(versao, fatias):
+    """Clientes distintos na união das fatias (OR dos conjuntos num bitset)."""
+    clientes, _ = clientes_das_fatias(versao, fatias)
+    marcados = np.zeros(fatias_clientes(versao)['total_clientes'], dtype=bool)
+    marcados[clientes] = True
+    return int(marcados.sum())
+
+
+@st.cache_data(max_entries=64)
+def clientes_ativos_por_mes(versao, filtros):
+    """Clientes distintos com compra em cada mês do conjunto filtrado."""
+    fatias = fatias_selecionadas(versao, filtros)
+    if fatias is None:
+        df_filtrado = filtrar_dados(versao, filtros)
+        return df_filtrado.groupby('DATA_REF')['CLIENTE'].nunique().rename('CLIENTES').reset_index()
+
+    estrutura = fatias_clientes(versao)
+    clientes, origem = clientes_das_fatias(versao, fatias)
+    # Um par (mês, cliente) distinto por cliente ativo no mês
+    meses_pares = fatias['MES_CODIGO'].to_numpy()[origem].astype('int64')
+    pares = np.unique(meses_pares * max(estrutura['total_clientes'], 1) + clientes)
+    contagem = np.bincount(pares // max(estrutura['total_clientes'], 1), minlength=len(estrutura['meses']))
+    presentes = np.unique(fatias['MES_CODIGO'].to_numpy())
+    return pd.DataFrame({
+        'DATA_REF': estrutura['meses'][presentes],
+        'CLIENTES': contagem[presentes],
+    })
+
+
+def preparar_indices(versao):
+    """Pré-calcula os índices (opções e busca dos filtros, partições) de uma versão antes de ela ser usada."""
+    for col in ['ANO', 'REPRESENTANTE', 'FAMILIA', 'UF', 'COORDENADOR', 'NOME', 'PRODUTO']:
+        opcoes_filtro(versao, col)
+    opcoes_filtro(versao, 'MÊS', mes_ordenacao=True)
+    for col in ['NOME', 'PRODUTO']:
+        indice_busca(versao, col)
+    particoes_dados(versao)
+    esbocos_preco(versao)
+    fatias_clientes(versao)
+
+
+# --- Relatório de Inicialização ---
+@st.cache_resource
+def relatorio_inicializacao():
+    """Marcos de tempo (em segundos) da inicialização do processo, compartilhados entre sessões."""
+    return {'importacoes': _TEMPO_IMPORTACOES}
+
+
+def registrar_marco(nome, segundos):
+    """Registra um marco de inicialização apenas na primeira vez em que ocorre."""
+    relatorio_inicializacao().setdefault(nome, segundos)
 
 
 # --- Carregar os Dados ---
 #ARQUIVO = 'Dados.csv'
 ARQUIVO = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vR78roOtheg4zIdS2FZb7WvF8UAb64nuH3nxbn8fJWEg-ZPsuy18m_AZCRfU2ST3-jJOurK0DmSo5PA/pub?output=csv' #Para tentar ler o arquivo no googledrive
            
-df = carregar_dados(ARQUIVO)
+# Pré-aquecimento: `python dashboard.py --preaquecer` carrega a fonte, monta os índices e
+# grava o snapshot antes de o servidor subir (ex.: no deploy, antes do `streamlit run`).
+if '--preaquecer' in sys.argv[1:]:
+    base_preaquecida = obter_base_dados(ARQUIVO, recarregar=True)
+    logger.info(f"Pré-aquecimento concluído: {relatorio_inicializacao()}")
+    sys.exit(0 if base_preaquecida is not None else 1)
 
-if df is None or df.empty:
+base_dados = obter_base_dados(ARQUIVO)
+
+if base_dados is None:
     st.info("A execução do dashboard foi interrompida devido a erros ou falta de dados.")
     st.stop() 
 
-# --- Dicionário de meses para ordenação correta (fora da função)
-mes_map_ordem = {
-    'janeiro': 1, 'fevereiro': 2, 'março': 3, 'abril': 4, 'maio': 5, 'junho': 6,
-    'julho': 7, 'agosto': 8, 'setembro': 9, 'outubro': 10, 'novembro': 11, 'dezembro': 12
-}
-
+df = base_dados.df
+# Todos os caches derivados (filtros, agregações, exportações, índices) usam a versão como chave
+VERSAO = base_dados.versao
 
 if st.sidebar.button("Recarregar Dados"):
-    # Esta função Streamlit limpa programaticamente todos os caches
-    st.cache_resource.clear() 
-    # Recarrega a página para buscar os novos dados
-    st.rerun()
+    # Relê a fonte e compara o fingerprint: se o conteúdo for idêntico nada é descartado
+    nova_base, situacao_recarga = recarregar_base_dados(ARQUIVO)
+    if nova_base is not None and nova_base.versao != VERSAO:
+        # Recarrega a página para usar a nova versão dos dados
+        st.rerun()
+    if situacao_recarga == 'erro':
+        st.sidebar.error("Não foi possível recarregar os dados; a versão atual continua em uso.")
+    elif situacao_recarga == 'ocupado':
+        st.sidebar.info("Outro processo já está recarregando os dados; tente novamente em instantes.")
+    else:
+        st.sidebar.success("Os dados já estão na versão mais recente.")
+
+st.sidebar.caption(
+    f"Versão dos dados: `{VERSAO[:8]}` · carregada em "
+    f"{base_dados.carregado_em.strftime('%d/%m/%Y %H:%M:%S')} ({len(df)} linhas)"
+)
+
+with st.sidebar.expander("⏱️ Tempos de inicialização"):
+    for marco, segundos in relatorio_inicializacao().items():
+        st.caption(f"{marco}: {segundos:.2f}s")
 
 st.sidebar.markdown("---")
 
@@ -200,19 +1190,12 @@ st.sidebar.markdown("---")
 st.sidebar.header("Filtros Interativos")
 
 # --- Função de Callback para o Checkbox ---
-def toggle_all(key_col, df_data, mes_ordenacao=False):
+def toggle_all(key_col, mes_ordenacao=False):
     """Função chamada quando o checkbox 'Selecionar Todos' é clicado."""
-    opcoes_disponiveis = df_data[key_col].unique().tolist()
-    
-    if mes_ordenacao:
-        opcoes_disponiveis = sorted(opcoes_disponiveis, key=lambda m: mes_map_ordem.get(m.lower().strip(), 0))
-    else:
-        opcoes_disponiveis = sorted(opcoes_disponiveis)
-    
     # Se o checkbox for True, define a lista de seleção como todas as opções.
     # Se for False, define a lista de seleção como vazia.
     if st.session_state[f"check_{key_col}"]:
-        st.session_state[f"filter_{key_col}"] = opcoes_disponiveis
+        st.session_state[f"filter_{key_col}"] = opcoes_filtro(VERSAO, key_col, mes_ordenacao)
     else:
         st.session_state[f"filter_{key_col}"] = []
 
@@ -220,47 +1203,71 @@ def toggle_all(key_col, df_data, mes_ordenacao=False):
 # --- Lógica de Inicialização do Session State ---
 # Devemos inicializar o st.session_state para as chaves do multiselect na primeira execução.
 # Se o estado não existir, inicializamos com TODAS as opções.
-def initialize_filter_state(key_col, df_data, mes_ordenacao=False):
+def initialize_filter_state(key_col, mes_ordenacao=False):
     if f"filter_{key_col}" not in st.session_state:
-        opcoes_disponiveis = df_data[key_col].unique().tolist()
-        if mes_ordenacao:
-            opcoes_disponiveis = sorted(opcoes_disponiveis, key=lambda m: mes_map_ordem.get(m.lower().strip(), 0))
-        else:
-            opcoes_disponiveis = sorted(opcoes_disponiveis)
-        
         # Inicializa com todas as opções selecionadas
-        st.session_state[f"filter_{key_col}"] = opcoes_disponiveis
+        st.session_state[f"filter_{key_col}"] = opcoes_filtro(VERSAO, key_col, mes_ordenacao)
         # Inicializa o checkbox como marcado
         st.session_state[f"check_{key_col}"] = True
 
+
+# --- Sincronização dos filtros com uma nova versão dos dados ---
+# Uma recarga (pelo botão ou pela atualização em segundo plano) pode trazer meses, anos ou
+# representantes novos. As seleções da sessão foram feitas sobre as opções da versão anterior:
+# um filtro que estava completo passaria a excluir os valores novos sem nenhum aviso.
+def sincronizar_filtros():
+    """
+    Ajusta as seleções da sessão às opções da versão atual. Filtros que estavam completos na
+    versão anterior (todas as opções, período inteiro) passam a incluir os valores novos; os
+    demais perdem apenas os valores que deixaram de existir.
+    """
+    estado = st.session_state.get('sincronia_filtros')
+    if estado is None or estado['versao'] == VERSAO:
+        return
+    for col in ['ANO', 'MÊS', 'REPRESENTANTE', 'FAMILIA', 'UF', 'COORDENADOR']:
+        if f"filter_{col}" not in st.session_state:
+            continue
+        opcoes = opcoes_filtro(VERSAO, col, mes_ordenacao=(col == 'MÊS'))
+        if col in estado['completos']:
+            st.session_state[f"filter_{col}"] = opcoes
+        else:
+            disponiveis = set(opcoes)
+            st.session_state[f"filter_{col}"] = [v for v in st.session_state[f"filter_{col}"] if v in disponiveis]
+    if estado['periodo_completo']:
+        # O slider volta ao período inteiro da nova versão (ver o filtro de Período)
+        st.session_state.pop('filter_PERIODO', None)
+
+
+sincronizar_filtros()
+
 # --- Geração dos Filtros ---
 
 # FILTRO: ANO
-initialize_filter_state('ANO', df)
+initialize_filter_state('ANO')
 st.sidebar.checkbox(
     "Selecionar todos (Ano)", 
     value=st.session_state["check_ANO"], 
     key="check_ANO",
     on_change=toggle_all, 
-    args=('ANO', df, False)
+    args=('ANO', False)
 )
 ano = st.sidebar.multiselect(
     "Ano:",
-    options=sorted(df['ANO'].unique()),
+    options=opcoes_filtro(VERSAO, 'ANO'),
     key='filter_ANO' # O valor deste multiselect é controlado pelo session_state e pelo checkbox
 )
 
 
 # FILTRO: MÊS
-initialize_filter_state('MÊS', df, mes_ordenacao=True)
+initialize_filter_state('MÊS', mes_ordenacao=True)
 st.sidebar.checkbox(
     "Selecionar todos (Mês)", 
     value=st.session_state["check_MÊS"], 
     key="check_MÊS",
     on_change=toggle_all, 
-    args=('MÊS', df, True)
+    args=('MÊS', True)
 )
-meses_disponiveis = sorted(df['MÊS'].unique(), key=lambda m: mes_map_ordem.get(m.lower().strip(), 0))
+meses_disponiveis = opcoes_filtro(VERSAO, 'MÊS', mes_ordenacao=True)
 mes = st.sidebar.multiselect(
     "Mês:",
     options=meses_disponiveis,
@@ -268,749 +1275,1523 @@ mes = st.sidebar.multiselect(
 )
 
 
+# FILTRO: PERÍODO (intervalo contínuo de meses, ex.: Nov/2024 a Mar/2025)
+# Combina com Ano/Mês: uma linha precisa atender aos três filtros.
+def rotulo_mes(data):
+    """Rótulo curto de um mês de referência (ex.: 'Nov/2024')."""
+    return f"{MESES_PT[data.month - 1][:3].capitalize()}/{data.year}"
+
+
+meses_periodo = opcoes_filtro(VERSAO, 'DATA_REF')
+if any(data not in meses_periodo for data in st.session_state.get('filter_PERIODO', ())):
+    # Meses que deixaram de existir após recarregar os dados: volta ao período completo
+    del st.session_state['filter_PERIODO']
+periodo = st.sidebar.select_slider(
+    "Período:",
+    options=meses_periodo,
+    value=(meses_periodo[0], meses_periodo[-1]),
+    format_func=rotulo_mes,
+    key='filter_PERIODO'
+)
+
+
 # FILTRO: REPRESENTANTE
-initialize_filter_state('REPRESENTANTE', df)
+initialize_filter_state('REPRESENTANTE')
 st.sidebar.checkbox(
     "Selecionar todos (Representante)", 
     value=st.session_state["check_REPRESENTANTE"], 
     key="check_REPRESENTANTE",
     on_change=toggle_all, 
-    args=('REPRESENTANTE', df, False)
+    args=('REPRESENTANTE', False)
 )
 representante = st.sidebar.multiselect(
     "Representante:",
-    options=sorted(df['REPRESENTANTE'].unique()),
+    options=opcoes_filtro(VERSAO, 'REPRESENTANTE'),
     key='filter_REPRESENTANTE'
 )
 
 
 # FILTRO: FAMÍLIA
-initialize_filter_state('FAMILIA', df)
+initialize_filter_state('FAMILIA')
 st.sidebar.checkbox(
     "Selecionar todos (Família)", 
     value=st.session_state["check_FAMILIA"], 
     key="check_FAMILIA",
     on_change=toggle_all, 
-    args=('FAMILIA', df, False)
+    args=('FAMILIA', False)
 )
 familia = st.sidebar.multiselect(
     "Família:",
-    options=sorted(df['FAMILIA'].unique()),
+    options=opcoes_filtro(VERSAO, 'FAMILIA'),
     key='filter_FAMILIA'
 )
 
 
 # FILTRO: UF
-initialize_filter_state('UF', df)
+initialize_filter_state('UF')
 st.sidebar.checkbox(
     "Selecionar todos (UF)", 
     value=st.session_state["check_UF"], 
     key="check_UF",
     on_change=toggle_all, 
-    args=('UF', df, False)
+    args=('UF', False)
 )
 uf = st.sidebar.multiselect(
     "UF:",
-    options=sorted(df['UF'].unique()),
+    options=opcoes_filtro(VERSAO, 'UF'),
     key='filter_UF'
 )
 
 
 # FILTRO: COORDENADOR
-initialize_filter_state('COORDENADOR', df)
+initialize_filter_state('COORDENADOR')
 st.sidebar.checkbox(
     "Selecionar todos (Coordenador)", 
     value=st.session_state["check_COORDENADOR"], 
     key="check_COORDENADOR",
     on_change=toggle_all, 
-    args=('COORDENADOR', df, False)
+    args=('COORDENADOR', False)
 )
 coordenador = st.sidebar.multiselect(
     "Coordenador:",
-    options=sorted(df['COORDENADOR'].unique()),
+    options=opcoes_filtro(VERSAO, 'COORDENADOR'),
     key='filter_COORDENADOR'
 )
 
+# --- Filtros de alta cardinalidade (Cliente e Produto) ---
+# Em vez de guardar no session_state (e enviar ao navegador) a lista com TODOS os clientes
+# e produtos, "Selecionar todos" funciona como um sentinela: quando marcado, o multiselect
+# passa a ser uma lista de EXCEÇÕES; quando desmarcado, é a lista de itens INCLUÍDOS.
+# As opções do multiselect são apenas os resultados da busca digitada (feita no servidor)
+# mais os itens já escolhidos, então o estado da sessão fica pequeno em qualquer cenário.
+def limpar_selecao(key_col):
+    """Ao alternar 'Selecionar todos' o significado da lista muda, então ela é esvaziada."""
+    st.session_state[f"filter_{key_col}"] = []
+
+
+def filtro_com_busca(key_col, rotulo):
+    """Desenha na barra lateral o filtro com busca no servidor para `key_col`."""
+    st.session_state.setdefault(f"check_{key_col}", True)
+    st.session_state.setdefault(f"filter_{key_col}", [])
+
+    todos = st.sidebar.checkbox(
+        f"Selecionar todos ({rotulo})",
+        key=f"check_{key_col}",
+        on_change=limpar_selecao,
+        args=(key_col,)
+    )
+    termo = st.sidebar.text_input(
+        f"Buscar {rotulo.lower()}:",
+        key=f"busca_{key_col}",
+        placeholder="Digite parte do nome ou código"
+    )
+
+    selecionados = st.session_state[f"filter_{key_col}"]
+    encontrados = buscar_opcoes(VERSAO, key_col, termo) if termo.strip() else []
+    rotulos = rotulos_busca(VERSAO, key_col)
+
+    return st.sidebar.multiselect(
+        f"{rotulo} (exceto):" if todos else f"{rotulo}:",
+        options=list(dict.fromkeys(selecionados + encontrados)),
+        format_func=lambda valor: rotulos.get(valor, str(valor)),
+        key=f"filter_{key_col}",
+        placeholder="Nenhuma exceção" if todos else "Busque acima para escolher"
+    )
+
+
 # FILTRO: CLIENTE (NOME)
-initialize_filter_state('NOME', df) # 'NOME' é o nome da coluna no seu CSV
-st.sidebar.checkbox(
-    "Selecionar todos (Cliente)", 
-    value=st.session_state["check_NOME"], 
-    key="check_NOME",
-    on_change=toggle_all, 
-    args=('NOME', df, False)
-)
-cliente = st.sidebar.multiselect(
-    "Cliente:",
-    options=sorted(df['NOME'].unique()),
-    key='filter_NOME'
-)
+cliente = filtro_com_busca('NOME', 'Cliente') # 'NOME' é o nome da coluna no seu CSV
 
 # FILTRO: PRODUTO
-initialize_filter_state('PRODUTO', df)
-st.sidebar.checkbox(
-    "Selecionar todos (Produto)", 
-    value=st.session_state["check_PRODUTO"], 
-    key="check_PRODUTO",
-    on_change=toggle_all, 
-    args=('PRODUTO', df, False)
-)
-produto = st.sidebar.multiselect(
-    "Produto:",
-    options=sorted(df['PRODUTO'].unique()),
-    key='filter_PRODUTO'
-)
+produto = filtro_com_busca('PRODUTO', 'Produto')
 
 
 
 # --- Filtrar o DataFrame com base nas seleções ---
-# Agora, as variáveis de filtro (ano, mes, etc.) são lidas diretamente do session_state
-# A variável 'ano' no código a seguir deve ser o valor de st.session_state['filter_ANO']
-# O multiselect key='filter_ANO' já retorna o valor para a variável 'ano' automaticamente.
-# No entanto, se o usuário não selecionar nada, o multiselect retorna uma lista vazia,
-# que é o que precisamos para o isin.
-
-# Lemos as variáveis de filtro do multiselect (que por sua vez, são controladas pelo session_state)
-ano = st.session_state['filter_ANO']
-mes = st.session_state['filter_MÊS']
-representante = st.session_state['filter_REPRESENTANTE']
-familia = st.session_state['filter_FAMILIA']
-uf = st.session_state['filter_UF']
-coordenador = st.session_state['filter_COORDENADOR']
-cliente = st.session_state['filter_NOME']
-produto = st.session_state['filter_PRODUTO']
-
-
-# (O restante do código, incluindo a filtragem do DataFrame, continua)
-# ----------------------------------------------------------------------------------
-
-# Se não houver nada selecionado em algum filtro (lista vazia), o isin([])
-# retornará um DataFrame vazio, que será tratado pelo if df_filtrado.empty.
-df_filtrado = df[
-    (df['ANO'].isin(ano)) &
-    (df['MÊS'].isin(mes)) &
-    (df['REPRESENTANTE'].isin(representante)) &
-    (df['FAMILIA'].isin(familia)) &
-    (df['UF'].isin(uf)) &
-    (df['COORDENADOR'].isin(coordenador)) &
-    (df['NOME'].isin(cliente)) &
-    (df['PRODUTO'].isin(produto))
-]
+# As seleções são lidas diretamente do session_state (controlado pelos multiselects e checkboxes)
+# e convertidas numa assinatura imutável. Essa assinatura é a chave de memoização de todas as
+# seções abaixo: enquanto os filtros não mudarem, cada seção reaproveita o resultado já calculado.
+#
+# Cada filtro vira (coluna, modo, valores), com modo:
+#   'todos'     -> nenhuma restrição (não gera máscara nem guarda a lista de valores)
+#   'incluir'   -> apenas os valores listados
+#   'excluir'   -> todos menos os valores listados (Cliente/Produto com "Selecionar todos")
+#   'intervalo' -> datas entre (início, fim), inclusive (filtro de Período sobre DATA_REF)
+COLUNAS_FILTRO = ['ANO', 'MÊS', 'REPRESENTANTE', 'FAMILIA', 'UF', 'COORDENADOR', 'NOME', 'PRODUTO']
+COLUNAS_COM_BUSCA = ['NOME', 'PRODUTO']
+
+def assinatura_filtros():
+    """Retorna os filtros atuais como uma tupla ordenada (hashável) de (coluna, modo, valores)."""
+    filtros = []
+    for col in COLUNAS_FILTRO:
+        selecionados = tuple(sorted(st.session_state[f'filter_{col}']))
+        if col in COLUNAS_COM_BUSCA:
+            if not st.session_state[f'check_{col}']:
+                filtros.append((col, 'incluir', selecionados))
+            elif selecionados:
+                filtros.append((col, 'excluir', selecionados))
+            else:
+                filtros.append((col, 'todos', ()))
+        elif set(selecionados) >= set(opcoes_filtro(VERSAO, col)):
+            filtros.append((col, 'todos', ()))
+        else:
+            filtros.append((col, 'incluir', selecionados))
+
+    meses = opcoes_filtro(VERSAO, 'DATA_REF')
+    periodo = tuple(st.session_state['filter_PERIODO'])
+    if periodo == (meses[0], meses[-1]):
+        filtros.append(('DATA_REF', 'todos', ()))
+    else:
+        filtros.append(('DATA_REF', 'intervalo', periodo))
+    return tuple(filtros)
+
+
+def mascara_filtros(df, filtros):
+    """Máscara booleana das linhas de `df` que atendem aos filtros (coluna, modo, valores)."""
+    # Se não houver nada selecionado em algum filtro (lista vazia), o isin([])
+    # retornará um DataFrame vazio, que será tratado pela verificação de sem_dados.
+    mascara = pd.Series(True, index=df.index)
+    for col, modo, valores in filtros:
+        if modo == 'incluir':
+            mascara &= df[col].isin(valores)
+        elif modo == 'excluir':
+            mascara &= ~df[col].isin(valores)
+        elif modo == 'intervalo':
+            mascara &= df[col].between(*valores)
+    return mascara
+
+
+@st.cache_resource(max_entries=4, ttl=600)
+def filtrar_dados(versao, filtros):
+    """
+    Aplica os filtros ao DataFrame carregado. O resultado é compartilhado (não copiado)
+    entre as seções e sessões, portanto NÃO deve ser alterado por quem o consome.
+    Cada entrada pode ser uma cópia de boa parte da base, então só as poucas seleções mais
+    recentes ficam em memória; os agregados de cada seção têm caches próprios e maiores.
+    """
+    filtros_particao = tuple(f for f in filtros if f[0] in COLUNAS_PARTICAO)
+    demais_filtros = [f for f in filtros if f[0] not in COLUNAS_PARTICAO and f[1] != 'todos']
+
+    if any(modo != 'todos' for _, modo, _ in filtros_particao):
+        df = dados_particoes(versao, filtros_particao)
+    else:
+        df = df_da_versao(versao)
+    if not demais_filtros:
+        return df
+
+    return df[mascara_filtros(df, demais_filtros)]
+
 
-if df_filtrado.empty:
+@st.cache_data(max_entries=64)
+def sem_dados(versao, filtros):
+    """
+    Indica se nenhuma linha atende aos filtros. Com filtros respondidos pelas fatias basta ver
+    se alguma fatia foi selecionada, sem montar o recorte das linhas (que fica para as seções
+    que precisam dele).
+    """
+    fatias = fatias_selecionadas(versao, filtros)
+    if fatias is not None:
+        return fatias.empty
+    return filtrar_dados(versao, filtros).empty
+
+
+filtros = assinatura_filtros()
+# Quais filtros estão completos nesta versão, para a sincronização após uma recarga
+st.session_state['sincronia_filtros'] = {
+    'versao': VERSAO,
+    'completos': {col for col, modo, _ in filtros if modo == 'todos' and col not in COLUNAS_COM_BUSCA},
+    'periodo_completo': dict((col, modo) for col, modo, _ in filtros)['DATA_REF'] == 'todos',
+}
+
+if sem_dados(VERSAO, filtros):
     st.warning("Nenhum dado encontrado para os filtros selecionados.")
     st.stop()
-    
-    
-# O restante do código (KPIs e Gráficos) continua aqui...
-# -------------------------------------------------------------
 
 
-# --- Exibir KPIs (Indicadores-Chave) ---
-st.subheader("Indicadores-Chave de Performance")
+# =====================================================================================
+# --- CÁLCULOS POR SEÇÃO (memoizados por estado de filtro) ---
+# Cada função recebe apenas a assinatura dos filtros (e parâmetros próprios da seção),
+# de modo que só é executada quando a seção correspondente é aberta e, depois disso,
+# apenas quando os filtros mudam.
+# =====================================================================================
 
-# Calcular KPIs
-total_rs = df_filtrado['FATURA_RS'].sum()
-total_kg = df_filtrado['FATURA_KG'].sum()
-preco_medio = (total_rs / total_kg) if total_kg > 0 else 0
-total_bonif_kg = df_filtrado['BONIF_KG'].sum()
-taxa_bonif = (total_bonif_kg / total_kg * 100) if total_kg > 0 else 0
-clientes_unicos = df_filtrado['CLIENTE'].nunique()
+@st.cache_data(max_entries=64)
+def calcular_kpis(versao, filtros):
+    """
+    Calcula os Indicadores-Chave de Performance para os filtros informados. Quando os filtros
+    são todos respondidos pelas fatias pré-agregadas, nenhuma linha de nota é lida.
+    """
+    fatias = fatias_selecionadas(versao, filtros)
+    if fatias is not None:
+        total_rs = fatias['FATURA_RS'].sum()
+        total_kg = fatias['FATURA_KG'].sum()
+        total_bonif_kg = fatias['BONIF_KG'].sum()
+        clientes_unicos = contar_clientes(versao, fatias)
+    else:
+        df_filtrado = filtrar_dados(versao, filtros)
+        total_rs = df_filtrado['FATURA_RS'].sum()
+        total_kg = df_filtrado['FATURA_KG'].sum()
+        total_bonif_kg = df_filtrado['BONIF_KG'].sum()
+        clientes_unicos = df_filtrado['CLIENTE'].nunique()
+    return {
+        'total_rs': total_rs,
+        'total_kg': total_kg,
+        'preco_medio': (total_rs / total_kg) if total_kg > 0 else 0,
+        'total_bonif_kg': total_bonif_kg,
+        'taxa_bonif': (total_bonif_kg / total_kg * 100) if total_kg > 0 else 0,
+        'clientes_unicos': clientes_unicos,
+    }
 
-# Função auxiliar para formatar em pt-BR (R$ 1.234,56)
-def formatar_br(valor, is_currency=True):
+
+@st.cache_data(max_entries=64)
+def agregar_graficos(versao, filtros):
+    """Agrega os dados usados pelos gráficos 1 a 6."""
+    df_filtrado = filtrar_dados(versao, filtros)
+    dados = {}
+    # Os totais são arredondados em centavos: casas decimais extras só aumentam o JSON enviado
+
+    # Gráfico 1: (Não precisamos de reindexação se todos os meses existirem)
+    dados['evolucao'] = df_filtrado.groupby('DATA_REF')['FATURA_RS'].sum().round(2).reset_index().sort_values(by='DATA_REF')
+
+    # Gráfico 2: Agrupa por Mês e Ano para a comparação e ordena os meses para o gráfico de barra
+    df_yoy = df_filtrado.groupby(['MÊS', 'ANO'])['FATURA_RS'].sum().round(2).reset_index()
+    df_yoy['MÊS_ORDEM'] = df_yoy['MÊS'].str.lower().map(mes_map_ordem)
+    dados['yoy'] = df_yoy.sort_values(by=['MÊS_ORDEM', 'ANO'])
+
+    # Gráfico 3: Top 15 Representantes, agrupados por Representante e por Ano
+    total_reps = df_filtrado.groupby('REPRESENTANTE')['FATURA_RS'].sum()
+    top_reps = total_reps.nlargest(15).index
+    df_top_reps = df_filtrado[df_filtrado['REPRESENTANTE'].isin(top_reps)]
+    dados['reps_ano'] = df_top_reps.groupby(['REPRESENTANTE', 'ANO'])['FATURA_RS'].sum().round(2).reset_index()
+    # Ordem dos representantes pelo total geral (apenas os 15 exibidos vão para o gráfico)
+    dados['rep_ordem'] = total_reps[top_reps].sort_values(ascending=True).index.tolist()
+
+    # Gráfico 4: Top 15 Clientes, agrupados por Cliente e por Ano
+    total_nomes = df_filtrado.groupby('NOME')['FATURA_RS'].sum()
+    top_nomes = total_nomes.nlargest(15).index
+    df_top_nomes = df_filtrado[df_filtrado['NOME'].isin(top_nomes)]
+    dados['clientes_ano'] = df_top_nomes.groupby(['NOME', 'ANO'])['FATURA_RS'].sum().round(2).reset_index()
+    # (ascending=True para o Plotly exibir de baixo para cima, do menor ao maior total)
+    dados['nome_ordem'] = total_nomes[top_nomes].sort_values(ascending=True).index.tolist()
+
+    # Gráfico 5: Composição por Família
+    dados['familia'] = df_filtrado.groupby('FAMILIA')['FATURA_RS'].sum().round(2).reset_index()
+
+    # Gráfico 6: Agrupa os dados por UF e por ANO
+    df_uf_ano = df_filtrado.groupby(['UF', 'ANO'])['FATURA_RS'].sum().round(2).reset_index()
+    dados['uf_ano'] = df_uf_ano.sort_values(by='FATURA_RS', ascending=False)
+
+    return dados
+
+
+@st.cache_data(max_entries=64)
+def agregar_produtos(versao, filtros):
+    """Prepara os dados do TOP 15 produtos (comum aos gráficos 7 e 8)."""
+    df_filtrado = filtrar_dados(versao, filtros)
+
+    # Agrupa os dados por produto e calcula o Faturamento Total (R$) e Volume Total (KG)
+    df_produtos_agregado = df_filtrado.groupby(['PRODUTO', 'DESCRICAO']).agg(
+        FATURA_RS=('FATURA_RS', 'sum'),
+        FATURA_KG=('FATURA_KG', 'sum')
+    ).reset_index()
+
+    # Seleciona os 15 produtos com maior faturamento (FATURA_RS)
+    df_top_15 = df_produtos_agregado.nlargest(15, 'FATURA_RS')
+
+    # Adiciona a coluna PRODUTO_COMPLETO
+    df_top_15['PRODUTO_COMPLETO'] = df_top_15['PRODUTO'] + ' - ' + df_top_15['DESCRICAO']
+
+    # Calcula o Preço Médio (R$/Kg) SOMA(R$)/SOMA(KG)
+    # Onde FATURA_KG é zero, preenche o preço médio com 0 para evitar divisão por zero
+    df_top_15['PRECO_MEDIO_CALCULADO'] = (df_top_15['FATURA_RS'] / df_top_15['FATURA_KG']).where(df_top_15['FATURA_KG'] > 0, 0)
+    return df_top_15
+
+
+@st.cache_data(max_entries=64)
+def calcular_precos(versao, filtros):
+    """
+    Análise de preços (PRECO_MEDIO) por produto, respondida a partir dos esboços: quantis,
+    dispersão, outliers e a mediana de cada mês com a variação sobre o mês anterior.
+    """
+    if all(modo == 'todos' for col, modo, _ in filtros if col not in FILTROS_ESBOCO):
+        esbocos = {
+            nome: tabela[mascara_filtros(tabela, filtros)]
+            for nome, tabela in esbocos_preco(versao).items()
+        }
+    else:
+        esbocos = montar_esbocos(filtrar_dados(versao, filtros))
+
+    def quantis(baldes, chaves, probabilidades):
+        """Quantis (pelo histograma somado) para cada grupo de `chaves`."""
+        histograma = baldes.groupby(chaves + ['BALDE'])['LINHAS'].sum().reset_index()
+        acumulado = histograma.groupby(chaves)['LINHAS'].cumsum()
+        total = histograma.groupby(chaves)['LINHAS'].transform('sum')
+        resultado = {}
+        for nome, probabilidade in probabilidades.items():
+            # Primeiro balde em que a contagem acumulada alcança a fração pedida
+            atingiu = histograma[acumulado >= probabilidade * total]
+            resultado[nome] = valor_balde(atingiu.groupby(chaves)['BALDE'].first())
+        return pd.DataFrame(resultado), histograma
+
+    # --- Distribuição por produto (todos os meses do filtro) ---
+    resumo = esbocos['totais'].groupby('PRODUTO')[['FATURA_RS', 'FATURA_KG']].sum()
+    resumo['PRECO_MEDIO_CALCULADO'] = (resumo['FATURA_RS'] / resumo['FATURA_KG']).where(resumo['FATURA_KG'] > 0, 0)
+    distribuicao, histograma = quantis(
+        esbocos['baldes'], ['PRODUTO'], {'P05': 0.05, 'P25': 0.25, 'P50': 0.5, 'P75': 0.75, 'P95': 0.95}
+    )
+    resumo = resumo.join(distribuicao, how='inner')
+    resumo['LINHAS'] = histograma.groupby('PRODUTO')['LINHAS'].sum()
+    resumo['DISPERSAO'] = (resumo['P75'] - resumo['P25']) / resumo['P50'] * 100
+
+    # Outliers: notas fora das cercas de Tukey (P25 - 1,5·IQR, P75 + 1,5·IQR) do produto
+    iqr = resumo['P75'] - resumo['P25']
+    cercas = histograma.join((resumo['P25'] - 1.5 * iqr).rename('MINIMO'), on='PRODUTO').join(
+        (resumo['P75'] + 1.5 * iqr).rename('MAXIMO'), on='PRODUTO'
+    )
+    preco_balde = valor_balde(cercas['BALDE'])
+    fora = cercas[(preco_balde < cercas['MINIMO']) | (preco_balde > cercas['MAXIMO'])]
+    resumo['OUTLIERS'] = fora.groupby('PRODUTO')['LINHAS'].sum().reindex(resumo.index, fill_value=0)
+    resumo = resumo.sort_values('FATURA_RS', ascending=False).reset_index()
+
+    # --- Mediana mês a mês ---
+    mensal, _ = quantis(esbocos['baldes'], ['PRODUTO', 'DATA_REF'], {'P50': 0.5})
+    mensal = mensal.reset_index().sort_values(['PRODUTO', 'DATA_REF'])
+    # Variação sobre o mês anterior em que o produto teve vendas
+    mensal['P50_ANTERIOR'] = mensal.groupby('PRODUTO')['P50'].shift()
+    mensal['VARIACAO'] = (mensal['P50'] / mensal['P50_ANTERIOR'] - 1) * 100
+    return {'resumo': resumo, 'mensal': mensal}
+
+
+@st.cache_data(max_entries=64)
+def calcular_inativos(versao, filtros, data_limite):
+    """
+    Retorna a tabela de clientes cuja última compra (dentro do conjunto filtrado)
+    foi anterior a `data_limite`.
+    """
+    # 1. Fonte de dados: Usamos o DF FILTRADO para refletir as seleções do usuário
+    # Isso garante que se o usuário filtrar por CE, só veremos clientes de CE.
+    df_filtrado = filtrar_dados(versao, filtros)
+
+    # 2. Encontrar a data da última compra (DATA_REF) para cada cliente
+    df_ultima_compra = df_filtrado.groupby('NOME')['DATA_REF'].max().reset_index()
+    df_ultima_compra.rename(columns={'DATA_REF': 'DATA_ULTIMA_COMPRA'}, inplace=True)
+
+    # 3. Filtrar inativos: Última compra anterior ao mês de referência (DINÂMICO)
+    df_inativos = df_ultima_compra[df_ultima_compra['DATA_ULTIMA_COMPRA'] < data_limite]
+
+    if df_inativos.empty:
+        return df_inativos
+
+    # 4. Trazer o nome do Representante e UF, eliminando duplicatas
+    df_caracteristicas = df_filtrado[['NOME', 'REPRESENTANTE', 'UF']].drop_duplicates(subset=['NOME'])
+    df_tabela_inativos = pd.merge(df_inativos, df_caracteristicas, on='NOME', how='left')
+
+    # 5. Cria a coluna 'Mês da Última Compra' formatada para exibição
+    datas = df_tabela_inativos['DATA_ULTIMA_COMPRA']
+    df_tabela_inativos['MÊS_ULTIMA_COMPRA'] = (
+        datas.dt.month.map(lambda m: MESES_PT[m - 1][:3]) + '/' + datas.dt.year.astype(str)
+    )
+
+    # 6. Ordenar: DATA_ULTIMA_COMPRA (desc.) e REPRESENTANTE (cresc.)
+    df_tabela_inativos.sort_values(
+        by=['DATA_ULTIMA_COMPRA', 'REPRESENTANTE'],
+        ascending=[False, True],
+        inplace=True
+    )
+
+    # 7. Selecionar e Renomear colunas
+    return df_tabela_inativos[[
+        'NOME',
+        'REPRESENTANTE',
+        'UF',
+        'MÊS_ULTIMA_COMPRA'
+    ]].rename(columns={
+        'NOME': 'Nome do Cliente',
+        'REPRESENTANTE': 'Representante',
+        'UF': 'UF',
+        'MÊS_ULTIMA_COMPRA': 'Mês da Última Compra'
+    })
+
+
+@st.cache_data(max_entries=64)
+def calcular_queda(versao, filtros, coluna_dados, periodo_1_list, periodo_2_list, label_metrica, sufixo_coluna):
+    """
+    Compara cada cliente entre o Período 1 e o Período 2 (listas de (ano, mês)) e
+    retorna apenas os que tiveram queda, ordenados pela maior queda.
+    """
+    # BASE DE DADOS: Usamos o DF FILTRADO
+    df_filtrado = filtrar_dados(versao, filtros)
+
+    # Marca os períodos comparando o par (ANO, MÊS) de cada linha de forma vetorizada
+    chave_periodo = pd.MultiIndex.from_arrays([df_filtrado['ANO'], df_filtrado['MÊS']])
+    is_p1 = chave_periodo.isin(periodo_1_list)
+    is_p2 = chave_periodo.isin(periodo_2_list)
+
+    # Agrupar os valores por cliente e por período (usando a COLUNA_DADOS DINÂMICA)
+    df_p1 = df_filtrado[is_p1].groupby('NOME')[coluna_dados].sum().reset_index()
+    df_p1.rename(columns={coluna_dados: 'P1_VALOR'}, inplace=True)
+
+    df_p2 = df_filtrado[is_p2].groupby('NOME')[coluna_dados].sum().reset_index()
+    df_p2.rename(columns={coluna_dados: 'P2_VALOR'}, inplace=True)
+
+    # Merge dos Volumes e Cálculo da Queda/Crescimento
+    df_resultado = pd.merge(df_p1, df_p2, on='NOME', how='outer').fillna(0)
+    df_resultado['QUEDA_VALOR'] = df_resultado['P1_VALOR'] - df_resultado['P2_VALOR']
+
+    # Filtrar apenas as Quedas (QUEDA_VALOR > 0)
+    df_queda = df_resultado[df_resultado['QUEDA_VALOR'] > 0].copy()
+
+    if df_queda.empty:
+        return pd.DataFrame()
+
+    # Trazer a UF
+    df_caracteristicas = df_filtrado[['NOME', 'UF']].drop_duplicates(subset=['NOME'])
+    df_final = pd.merge(df_queda, df_caracteristicas, on='NOME', how='left')
+
+    # Ordenar pela maior queda
+    df_final.sort_values(by='QUEDA_VALOR', ascending=False, inplace=True)
+
+    # Selecionar e Renomear Colunas
+    return df_final[[
+        'NOME',
+        'UF',
+        'P1_VALOR',
+        'P2_VALOR',
+        'QUEDA_VALOR'
+    ]].rename(columns={
+        'NOME': 'Nome do Cliente',
+        'UF': 'UF',
+        'P1_VALOR': f'{label_metrica} (Período 1) {sufixo_coluna}',
+        'P2_VALOR': f'{label_metrica} (Período 2) {sufixo_coluna}',
+        'QUEDA_VALOR': f'Queda no {label_metrica} {sufixo_coluna}'
+    })
+
+
+@st.cache_data(max_entries=16)
+def exportar_queda_excel(versao, filtros, coluna_dados, periodo_1_list, periodo_2_list, label_metrica, sufixo_coluna):
+    """Gera o arquivo Excel da Tabela 9 (uma única vez por versão dos dados e filtros)."""
+    # AQUI EXPORTAMOS O DATAFRAME COM DADOS NUMÉRICOS
+    return to_excel(calcular_queda(versao, filtros, coluna_dados, periodo_1_list, periodo_2_list, label_metrica, sufixo_coluna))
+
+
+# --- Relatório Completo (Excel com todas as seções) ---
+# O relatório é gerado por um pool de threads, fora da execução do script: a sessão apenas
+# acompanha o progresso (num fragmento que se atualiza sozinho) e baixa o arquivo pronto.
+# Os arquivos ficam em memória por (versão dos dados, filtros, observações, mês de
+# referência), então o mesmo relatório não é gerado duas vezes, nem por sessões diferentes.
+TRABALHADORES_RELATORIO = int(os.environ.get('DASHBOARD_TRABALHADORES_RELATORIO', 2))
+MAX_RELATORIOS = 8  # Relatórios prontos mantidos em memória (os mais antigos saem primeiro)
+
+# Métricas da Tabela 9: (coluna, rótulo, sufixo), como no seletor da seção
+METRICAS_QUEDA = {
+    'Volume (KG)': ('FATURA_KG', 'Volume', '(KG)'),
+    'Vendas (R$)': ('FATURA_RS', 'Venda', '(R$)'),
+}
+
+
+def periodos_tabela9(anos, meses, filtros):
+    """
+    Lista ordenada de todos os pares (ano, mês) selecionados, base da Tabela 9. Com o filtro
+    de Período ativo, ficam apenas os pares cujo mês está dentro do intervalo.
+    """
+    periodos = [
+        (ano_sel, mes_sel)
+        for ano_sel in sorted(anos)
+        for mes_sel in sorted(meses, key=lambda m: mes_map_ordem.get(m.lower().strip(), 0))
+    ]
+    intervalo = next((valores for col, modo, valores in filtros if col == 'DATA_REF' and modo == 'intervalo'), None)
+    if intervalo is None:
+        return periodos
+    inicio, fim = intervalo
+    return [
+        (ano_sel, mes_sel)
+        for ano_sel, mes_sel in periodos
+        if inicio <= pd.Timestamp(int(ano_sel), mes_map_ordem.get(mes_sel.lower().strip(), 0), 1) <= fim
+    ]
+
+
+def valores_filtro(versao, filtros, col):
+    """Valores selecionados de um filtro de lista (todas as opções quando o modo é 'todos')."""
+    for coluna, modo, valores in filtros:
+        if coluna == col and modo != 'todos':
+            return list(valores)
+    return opcoes_filtro(versao, col, mes_ordenacao=(col == 'MÊS'))
+
+
+@st.cache_resource
+def fila_relatorios():
+    """Pool de geração e relatórios por chave, compartilhados por todas as sessões."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    return {
+        'pool': ThreadPoolExecutor(max_workers=TRABALHADORES_RELATORIO, thread_name_prefix='relatorio'),
+        'tarefas': {},
+        'lock': threading.Lock(),
+    }
+
+
+def chave_relatorio(versao, filtros):
+    """Identifica um relatório: muda com os dados, os filtros, as observações ou o mês."""
     try:
-        if is_currency:
-            return f"R$ {valor:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
-        else:
-            return f"{valor:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
-    except:
-        return f"{valor}"
+        versao_observacoes = os.path.getmtime(OBS_FILE)
+    except OSError:
+        versao_observacoes = None
+    return (versao, filtros, versao_observacoes, datetime.date.today().strftime('%Y-%m'))
+
+
+def abas_relatorio(versao, filtros):
+    """Abas do relatório: (nome da aba, função que monta o DataFrame ou None para pular)."""
+    data_limite = pd.to_datetime(datetime.datetime.now().strftime('%Y-%m-01'))
+
+    def filtros_aplicados():
+        linhas = [('Versão dos dados', '', versao[:8])]
+        for col, modo, valores in filtros:
+            if modo == 'intervalo':
+                valores = [rotulo_mes(data) for data in valores]
+            linhas.append((col, modo, ', '.join(str(valor) for valor in valores)))
+        return pd.DataFrame(linhas, columns=['Filtro', 'Modo', 'Valores'])
+
+    def indicadores():
+        kpis = calcular_kpis(versao, filtros)
+        return pd.DataFrame([
+            ('Venda Total (R$)', kpis['total_rs']),
+            ('Volume Total (Kg)', kpis['total_kg']),
+            ('Clientes Únicos', kpis['clientes_unicos']),
+            ('Preço Médio (R$/Kg)', kpis['preco_medio']),
+            ('Bonificação (Kg)', kpis['total_bonif_kg']),
+            ('Taxa de Bonificação (%)', kpis['taxa_bonif']),
+        ], columns=['Indicador', 'Valor'])
+
+    def grafico(nome, colunas=None):
+        def montar():
+            dados = agregar_graficos(versao, filtros)[nome]
+            return dados[colunas] if colunas else dados
+        return montar
+
+    def queda(metrica):
+        def montar():
+            periodos = periodos_tabela9(valores_filtro(versao, filtros, 'ANO'), valores_filtro(versao, filtros, 'MÊS'), filtros)
+            if not periodos or len(periodos) % 2 != 0:
+                return None
+            meio = len(periodos) // 2
+            coluna, rotulo, sufixo = METRICAS_QUEDA[metrica]
+            return calcular_queda(versao, filtros, coluna, tuple(periodos[:meio]), tuple(periodos[meio:]), rotulo, sufixo)
+        return montar
+
+    def observacoes_filtradas():
+        clientes = set(filtrar_dados(versao, filtros)['NOME'])
+        return pd.DataFrame(
+            [(cliente, texto) for cliente, texto in carregar_observacoes().items() if cliente in clientes],
+            columns=['Cliente', 'Observação']
+        )
+
+    return [
+        ('Filtros', filtros_aplicados),
+        ('Indicadores', indicadores),
+        ('Evolução Mensal', grafico('evolucao')),
+        ('Ano a Ano', grafico('yoy', ['MÊS', 'ANO', 'FATURA_RS'])),
+        ('Top Representantes', grafico('reps_ano')),
+        ('Top Clientes', grafico('clientes_ano')),
+        ('Famílias', grafico('familia')),
+        ('UF', grafico('uf_ano')),
+        ('Top Produtos', lambda: agregar_produtos(versao, filtros)),
+        ('Preços', lambda: calcular_precos(versao, filtros)['resumo']),
+        ('Clientes Inativos', lambda: calcular_inativos(versao, filtros, data_limite)),
+        ('Tabela 9 (KG)', queda('Volume (KG)')),
+        ('Tabela 9 (R$)', queda('Vendas (R$)')),
+        ('Observações', observacoes_filtradas),
+    ]
+
+
+def gerar_relatorio(tarefa, versao, filtros):
+    """Gera o Excel com uma aba por seção, atualizando o progresso da tarefa a cada aba."""
+    inicio = time.perf_counter()
+    abas = abas_relatorio(versao, filtros)
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        for posicao, (nome_aba, montar) in enumerate(abas):
+            tarefa['etapa'] = nome_aba
+            df = montar()
+            if df is not None and not df.empty:
+                df.to_excel(writer, index=False, sheet_name=nome_aba)
+                formatar_colunas_numericas_excel(writer, nome_aba, df)
+            tarefa['progresso'] = (posicao + 1) / len(abas)
+    tarefa['etapa'] = 'Concluído'
+    logger.info(f"Relatório completo gerado em {time.perf_counter() - inicio:.2f}s (versão {versao[:8]})")
+    return output.getvalue()
+
+
+def tarefa_relatorio(versao, filtros):
+    """Tarefa de geração do relatório para os filtros atuais (ou None se nunca foi pedida)."""
+    return fila_relatorios()['tarefas'].get(chave_relatorio(versao, filtros))
+
+
+def solicitar_relatorio(versao, filtros):
+    """Enfileira a geração do relatório, se ainda não houver uma tarefa para a mesma chave."""
+    fila = fila_relatorios()
+    chave = chave_relatorio(versao, filtros)
+    with fila['lock']:
+        tarefa = fila['tarefas'].get(chave)
+        # Uma tarefa que falhou pode ser pedida de novo; as demais são reaproveitadas
+        if tarefa is not None and not (tarefa['futuro'].done() and tarefa['futuro'].exception()):
+            return tarefa
+        tarefa = {'progresso': 0.0, 'etapa': 'Na fila'}
+        tarefa['futuro'] = fila['pool'].submit(gerar_relatorio, tarefa, versao, filtros)
+        fila['tarefas'][chave] = tarefa
+        # Descarta os relatórios mais antigos (dicionário em ordem de inserção)
+        for antiga in list(fila['tarefas'])[:-MAX_RELATORIOS]:
+            del fila['tarefas'][antiga]
+    return tarefa
+
+
+def acompanhar_relatorio(versao, filtros):
+    """Fragmento que mostra o progresso da geração; ao terminar, reexecuta o app."""
+    tarefa = tarefa_relatorio(versao, filtros)
+    if tarefa is None or tarefa['futuro'].done():
+        st.rerun()
+    st.progress(tarefa['progresso'], text=f"Gerando relatório... ({tarefa['etapa']})")
 
-col1, col2, col3 = st.columns(3)
-col1.metric("Venda Total (R$)", formatar_br(total_rs))
-col2.metric("Volume Total (Kg)", f"{formatar_br(total_kg, is_currency=False)} Kg")
-col3.metric("Clientes Únicos", f"{clientes_unicos}")
 
-col4, col5, col6 = st.columns(3)
-col4.metric("Preço Médio (R$/Kg)", formatar_br(preco_medio))
-col5.metric("Bonificação (Kg)", f"{formatar_br(total_bonif_kg, is_currency=False)} Kg")
-col6.metric("Taxa de Bonificação (%)", f"{formatar_br(taxa_bonif, is_currency=False)}%")
+def painel_relatorio(versao, filtros):
+    """Barra lateral: pedir, acompanhar e baixar o relatório completo dos filtros atuais."""
+    st.markdown("---")
+    st.markdown("**📥 Relatório completo (Excel)**")
+    tarefa = tarefa_relatorio(versao, filtros)
+
+    if tarefa is not None and tarefa['futuro'].done():
+        erro = tarefa['futuro'].exception()
+        if erro is None:
+            st.download_button(
+                label="Baixar relatório 📊",
+                data=tarefa['futuro'].result(),
+                file_name=f'Relatorio_Vendas_{versao[:8]}.xlsx',
+                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                on_click='ignore',
+                type="primary"
+            )
+            return
+        if isinstance(erro, KeyError):
+            # A versão pedida saiu do registro (os dados foram atualizados mais de uma vez)
+            st.warning("Os dados foram atualizados; gere o relatório novamente.")
+        else:
+            logger.error(f"Falha ao gerar o relatório completo: {erro}")
+            st.error(f"Não foi possível gerar o relatório: {erro}")
+    elif tarefa is not None:
+        # Atualiza só o fragmento (não o app inteiro) a cada segundo enquanto a geração roda
+        st.fragment(acompanhar_relatorio, run_every=1)(versao, filtros)
+        return
+
+    st.caption("Todas as seções (indicadores, gráficos, inativos, Tabela 9 e observações) para os filtros atuais.")
+    if st.button("Gerar relatório"):
+        solicitar_relatorio(versao, filtros)
+        st.rerun()
+
+
+# --- Orçamento de Payload dos Gráficos ---
+# Cada figura é serializada em JSON e enviada ao navegador a cada execução. Medimos o
+# tamanho (e o tempo de construção) de cada uma quando é montada; como as figuras ficam
+# em cache por versão e filtros, a medição vale para todas as execuções seguintes.
+ORCAMENTO_BYTES_RERUN = int(os.environ.get('DASHBOARD_ORCAMENTO_BYTES', 400_000))
+
+
+def medir_grafico(graficos, nome, inicio, fig):
+    """Guarda a figura com seu tempo de construção e tamanho serializado."""
+    graficos[nome] = {
+        'figura': fig,
+        'segundos': time.perf_counter() - inicio,
+        'bytes': len(fig.to_json()),
+    }
+
 
-st.markdown("---") 
-st.subheader("Análises Gráficas")
+def exibir_grafico(graficos, nome, payload):
+    """Exibe uma figura montada e anota sua medição em `payload` (o acumulador da seção)."""
+    st.plotly_chart(graficos[nome]['figura'], config={})
+    payload[nome] = {'bytes': graficos[nome]['bytes'], 'segundos': graficos[nome]['segundos']}
+
+
+def exibir_orcamento_payload(payload):
+    """Resumo do payload de gráficos da seção, com alerta se passar do orçamento."""
+    if not payload:
+        return
+    total = sum(item['bytes'] for item in payload.values())
+    with st.expander(f"📦 Payload dos gráficos: {total / 1024:.0f} KB (orçamento {ORCAMENTO_BYTES_RERUN / 1024:.0f} KB)"):
+        st.dataframe(
+            pd.DataFrame(
+                [(nome, item['bytes'] / 1024, item['segundos'] * 1000) for nome, item in payload.items()],
+                columns=['Gráfico', 'Tamanho (KB)', 'Construção (ms)']
+            ),
+            hide_index=True,
+            column_config={'Tamanho (KB)': FORMATO_NUMERO_TABELA, 'Construção (ms)': FORMATO_NUMERO_TABELA}
+        )
+    if total > ORCAMENTO_BYTES_RERUN:
+        logger.warning(f"Payload de gráficos acima do orçamento: {total} bytes (limite {ORCAMENTO_BYTES_RERUN})")
+        st.warning("Os gráficos desta seção excederam o orçamento de dados por execução; refine os filtros para carregá-los mais rápido.")
+
+
+@st.cache_resource(max_entries=32)
+def montar_graficos_kpis(versao, filtros):
+    """Constrói (e mede) a figura de clientes ativos por mês da seção de indicadores."""
+    import plotly.express as px
+
+    graficos = {}
+    inicio = time.perf_counter()
+    fig_clientes = px.line(
+        clientes_ativos_por_mes(versao, filtros),
+        x='DATA_REF',
+        y='CLIENTES',
+        title="Clientes Ativos por Mês",
+        labels={'DATA_REF': 'Data', 'CLIENTES': 'Clientes com compra no mês'},
+        markers=True,
+    )
+    medir_grafico(graficos, 'clientes_ativos', inicio, fig_clientes)
+    return graficos
 
-# --- GRÁFICOS (Layout) ---
-col_graf1, col_graf2 = st.columns(2)
-col_graf3, col_graf4 = st.columns(2)
 
+@st.cache_resource(max_entries=32)
+def montar_graficos(versao, filtros):
+    """
+    Constrói as figuras dos gráficos 1 a 6 (uma vez por versão e filtros) e mede o
+    tempo de construção e o tamanho serializado de cada uma.
+    """
+    import plotly.express as px
 
-# Gráfico 1: Evolução do Faturamento Mensal (Linha)
-with col_graf1:
-    # 1. Agrupar os dados filtrados (Não precisamos de reindexação se todos os meses existirem)
-    df_evolucao = df_filtrado.groupby('DATA_REF')['FATURA_RS'].sum().reset_index()
+    dados = agregar_graficos(versao, filtros)
+    graficos = {}
 
-    # 2. Criar o gráfico
+    # Gráfico 1: Evolução do Faturamento Mensal (Linha)
+    inicio = time.perf_counter()
     fig_evolucao = px.line(
-        df_evolucao.sort_values(by='DATA_REF'), 
-        x='DATA_REF', 
-        y='FATURA_RS', 
+        dados['evolucao'],
+        x='DATA_REF',
+        y='FATURA_RS',
         title="1. Evolução das vendas Mensal (R$) - Meses Contínuos",
         labels={'DATA_REF': 'Data', 'FATURA_RS': 'Faturamento (R$)'}
     )
-    
-    # 3. Configuração para forçar a exibição de todos os meses no eixo X
+
+    # Configuração para forçar a exibição de todos os meses no eixo X
     fig_evolucao.update_xaxes(
         # Formato: Exibe o mês abreviado e o ano (Jan 2025)
-        tickformat="%b %Y", 
+        tickformat="%b %Y",
         # Força um 'tick' (rótulo) a cada 1 mês ('M1')
         dtick="M1",
         # Configura para exibir todas as datas disponíveis, se possível, sem otimização
-        type='date' 
+        type='date'
     )
-    
-    #st.plotly_chart(fig_evolucao, width='stretch')
-    #st.plotly_chart(fig_evolucao, width='stretch', config={})
-    st.plotly_chart(fig_evolucao, config={})
-
-# Gráfico 2: NOVO - Comparação Anual (YoY)
-with col_graf2:
-    # Agrupa por Mês e Ano para a comparação
-    df_yoy = df_filtrado.groupby(['MÊS', 'ANO'])['FATURA_RS'].sum().reset_index()
-    
-    # Ordena os meses para o gráfico de barra
-    df_yoy['MÊS_ORDEM'] = df_yoy['MÊS'].str.lower().map(mes_map_ordem)
-    df_yoy = df_yoy.sort_values(by=['MÊS_ORDEM', 'ANO'])
-    
+    medir_grafico(graficos, 'evolucao', inicio, fig_evolucao)
+
+    # Gráfico 2: Comparação Anual (YoY)
+    inicio = time.perf_counter()
     fig_yoy = px.bar(
-        df_yoy, 
-        x='MÊS', 
-        y='FATURA_RS', 
-        color='ANO', 
-        barmode='stack', # Barras lado a lado
+        dados['yoy'],
+        x='MÊS',
+        y='FATURA_RS',
+        color='ANO',
+        barmode='stack',
         title="2. Comparação Anual (YoY) - Vendas por Mês",
         labels={'MÊS': 'Mês', 'FATURA_RS': 'Faturamento (R$)', 'ANO': 'Ano'}
     )
-    #st.plotly_chart(fig_yoy, width='stretch' , config={})
-    st.plotly_chart(fig_yoy, config={})
-
+    medir_grafico(graficos, 'yoy', inicio, fig_yoy)
 
-# Gráfico 3: Top 10 Representantes (R$) por Ano
-with col_graf3:
-    # 1. Calcular o Faturamento TOTAL de cada representante no período filtrado para determinar o TOP 10
-    # Usamos REPRESENTANTE, que é a coluna que você usa para filtrar
-    top_10_reps = df_filtrado.groupby('REPRESENTANTE')['FATURA_RS'].sum().nlargest(15).index
-    
-    # 2. Filtrar o DataFrame apenas para esses Top 10 Representantes
-    df_top_10_reps = df_filtrado[df_filtrado['REPRESENTANTE'].isin(top_10_reps)]
-    
-    # 3. Agrupar os dados dos Top 10 por Representante e por Ano
-    df_reps_ano = df_top_10_reps.groupby(['REPRESENTANTE', 'ANO'])['FATURA_RS'].sum().reset_index()
-    
-    # 4. Criar o gráfico de barras, usando 'ANO' como cor para separação
+    # Gráfico 3: Top 15 Representantes (R$) por Ano
+    inicio = time.perf_counter()
     fig_top_reps = px.bar(
-        df_reps_ano, 
-        x='FATURA_RS', 
-        y='REPRESENTANTE', 
-        color='ANO',  # NOVO: Separa por ano
-        barmode='stack', # MODO: Barras lado a lado
+        dados['reps_ano'],
+        x='FATURA_RS',
+        y='REPRESENTANTE',
+        color='ANO',  # Separa por ano
+        barmode='stack',
         orientation='h',
-        title="3. Top 15 Representantes (R$) Comparado por Ano", 
+        title="3. Top 15 Representantes (R$) Comparado por Ano",
         labels={'REPRESENTANTE': 'Representante', 'FATURA_RS': 'Faturamento (R$)', 'ANO': 'Ano'}
     )
-    
     # Ajusta a ordem para que os representantes fiquem ordenados pelo total geral
-    rep_ordem = df_filtrado.groupby('REPRESENTANTE')['FATURA_RS'].sum().sort_values(ascending=True).index.tolist()
-    fig_top_reps.update_layout(yaxis={'categoryorder':'array', 'categoryarray':rep_ordem})
+    fig_top_reps.update_layout(yaxis={'categoryorder': 'array', 'categoryarray': dados['rep_ordem']})
+    medir_grafico(graficos, 'top_reps', inicio, fig_top_reps)
 
-    #st.plotly_chart(fig_top_reps, width='stretch' , config={})
-    st.plotly_chart(fig_top_reps, config={})
-
-# Gráfico 4: Top 15 Clientes (R$) por Ano
-with col_graf4:
-    # 1. Calcular o Faturamento TOTAL de cada cliente no período filtrado para determinar o TOP 10
-    top_10_nomes = df_filtrado.groupby('NOME')['FATURA_RS'].sum().nlargest(15).index
-    
-    # 2. Filtrar o DataFrame apenas para esses Top 10 Clientes
-    df_top_10 = df_filtrado[df_filtrado['NOME'].isin(top_10_nomes)]
-    
-    # 3. Agrupar os dados dos Top 10 por Cliente e por Ano
-    df_clientes_ano = df_top_10.groupby(['NOME', 'ANO'])['FATURA_RS'].sum().reset_index()
-    
-    # 4. Criar o gráfico de barras, usando 'ANO' como cor para separação
+    # Gráfico 4: Top 15 Clientes (R$) por Ano
+    inicio = time.perf_counter()
     fig_top_clientes = px.bar(
-        df_clientes_ano, 
-        x='FATURA_RS', 
-        y='NOME', 
+        dados['clientes_ano'],
+        x='FATURA_RS',
+        y='NOME',
         color='ANO',  # COR: Separa por ano
-        barmode='stack', # MODO: Barras lado a lado (em vez de empilhadas)
+        barmode='stack',
         orientation='h',
-        title="4. Top 15 Clientes (R$) Comparado por Ano", 
+        title="4. Top 15 Clientes (R$) Comparado por Ano",
         labels={'NOME': 'Cliente', 'FATURA_RS': 'Faturamento (R$)', 'ANO': 'Ano'}
     )
-    
     # Ajusta a ordem para que os clientes fiquem ordenados pelo total geral, do menor para o maior
-    # (ascending=True para o Plotly exibir de baixo para cima, do menor ao maior total)
-    nome_ordem = df_filtrado.groupby('NOME')['FATURA_RS'].sum().sort_values(ascending=True).index.tolist()
-    fig_top_clientes.update_layout(yaxis={'categoryorder':'array', 'categoryarray':nome_ordem})
-
-    #st.plotly_chart(fig_top_clientes, width='stretch', config={})
-    st.plotly_chart(fig_top_clientes, config={})
-
-col_graf5, col_graf6 = st.columns(2)
+    fig_top_clientes.update_layout(yaxis={'categoryorder': 'array', 'categoryarray': dados['nome_ordem']})
+    medir_grafico(graficos, 'top_clientes', inicio, fig_top_clientes)
 
-# Gráfico 5: Composição do Faturamento por Família (Pizza)
-with col_graf5:
-    df_familia = df_filtrado.groupby('FAMILIA')['FATURA_RS'].sum().reset_index()
+    # Gráfico 5: Composição do Faturamento por Família (Pizza)
+    inicio = time.perf_counter()
     fig_familia = px.pie(
-        df_familia, 
-        values='FATURA_RS', 
-        names='FAMILIA', 
+        dados['familia'],
+        values='FATURA_RS',
+        names='FAMILIA',
         title="5. Composição das vendsa por Família (R$)"
     )
-    #st.plotly_chart(fig_familia, width='stretch' , config={})
-    st.plotly_chart(fig_familia, config={})
-
-# Gráfico 6: Faturamento por UF (Comparado por Ano)
-with col_graf6:
-    # Agrupa os dados por UF e por ANO
-    df_uf_ano = df_filtrado.groupby(['UF', 'ANO'])['FATURA_RS'].sum().reset_index()
-    df_uf_ano.sort_values(by='FATURA_RS', ascending=False, inplace=True)
-    
+    medir_grafico(graficos, 'familia', inicio, fig_familia)
+
+    # Gráfico 6: Faturamento por UF (Comparado por Ano)
+    inicio = time.perf_counter()
     fig_uf = px.bar(
-        #df_uf_ano.sort_values(by='FATURA_RS', ascending=False),
-        df_uf_ano, 
-        x='UF', 
-        y='FATURA_RS', 
-        color='ANO', # NOVO: Separa por ano
-        barmode='stack', # MODO: Barras lado a lado
+        dados['uf_ano'],
+        x='UF',
+        y='FATURA_RS',
+        color='ANO',  # Separa por ano
+        barmode='stack',
         title="6. Vendas por UF (R$) Comparado por Ano",
         labels={'UF': 'Estado', 'FATURA_RS': 'Venda (R$)', 'ANO': 'Ano'}
     )
     # Garante que o eixo X (UF) não seja cortado se tiver muitas UFs
-    fig_uf.update_xaxes(tickangle=45) 
-
-    #st.plotly_chart(fig_uf, width='stretch', config={})
-    st.plotly_chart(fig_uf, config={})
+    fig_uf.update_xaxes(tickangle=45)
+    medir_grafico(graficos, 'uf', inicio, fig_uf)
 
-    # --- Adicionar uma nova linha de gráficos para o Gráfico 7 (Top Produtos) ---
+    return graficos
 
-st.markdown("---") 
-st.subheader("Análise de Produtos")
 
-col_graf7, col_graf8 = st.columns([1, 1]) # O gráfico 7 usará a primeira coluna (col_graf7), a segunda será vazia ou para futuro uso
+@st.cache_resource(max_entries=32)
+def montar_graficos_produtos(versao, filtros):
+    """Constrói (e mede) as figuras dos gráficos 7 e 8."""
+    import plotly.express as px
 
+    df_top_15 = agregar_produtos(versao, filtros)
+    graficos = {}
 
-# --- Análise de Produtos: Gráfico 7 (Pizza) e Gráfico 8 (Preço Médio) ---
-#st.markdown("---") 
-#st.subheader("Análise de Produtos")    
-
-# 1. Preparação dos Dados para o TOP 15 (Comum aos dois gráficos)
-# Agrupa os dados por produto e calcula o Faturamento Total (R$) e Volume Total (KG)
-df_produtos_agregado = df_filtrado.groupby(['PRODUTO', 'DESCRICAO']).agg(
-    FATURA_RS=('FATURA_RS', 'sum'),
-    FATURA_KG=('FATURA_KG', 'sum')
-).reset_index()
-
-# Seleciona os 15 produtos com maior faturamento (FATURA_RS)
-df_top_15 = df_produtos_agregado.nlargest(15, 'FATURA_RS')
-
-# Adiciona a coluna PRODUTO_COMPLETO
-df_top_15['PRODUTO_COMPLETO'] = df_top_15['PRODUTO'] + ' - ' + df_top_15['DESCRICAO']
-
-# Calcula o Preço Médio (R$/Kg) SOMA(R$)/SOMA(KG)
-# Onde FATURA_KG é zero, preenche o preço médio com 0 para evitar divisão por zero
-df_top_15['PRECO_MEDIO_CALCULADO'] = df_top_15.apply(
-    lambda row: row['FATURA_RS'] / row['FATURA_KG'] if row['FATURA_KG'] > 0 else 0,
-    axis=1
-)
-
-
-# Criação das colunas para os gráficos 7 e 8
-col_graf7, col_graf8 = st.columns(2) 
-
-
-# --- GRÁFICO 7: Top 15 Produtos (R$) - PIZZA ---
-with col_graf7:
-    
-    # 4. Criar o gráfico de pizza (usando df_top_15)
+    # --- GRÁFICO 7: Top 15 Produtos (R$) - PIZZA ---
+    inicio = time.perf_counter()
     fig_top_produtos = px.pie(
-        df_top_15, 
-        values='FATURA_RS', 
-        names='PRODUTO_COMPLETO', 
+        df_top_15,
+        values='FATURA_RS',
+        names='PRODUTO_COMPLETO',
         title="7. Top 15 Produtos Mais Vendidos (R$)",
-        hole=.3, 
+        hole=.3,
         hover_data=['PRODUTO', 'DESCRICAO'],
     )
-    
     fig_top_produtos.update_traces(textposition='inside', textinfo='percent+label')
     fig_top_produtos.update_layout(showlegend=True)
+    medir_grafico(graficos, 'top_produtos', inicio, fig_top_produtos)
 
-    #st.plotly_chart(fig_top_produtos, width='stretch', config={})
-    st.plotly_chart(fig_top_produtos, config={})
-
-
-# --- GRÁFICO 8: Top 15 Produtos - PREÇO MÉDIO CALCULADO ---
-with col_graf8:
+    # --- GRÁFICO 8: Top 15 Produtos - PREÇO MÉDIO CALCULADO ---
+    inicio = time.perf_counter()
     # Ordena os produtos pelo Preço Médio Calculado (do menor para o maior)
     df_pmv_ordenado = df_top_15.sort_values(by='PRECO_MEDIO_CALCULADO', ascending=True)
 
     fig_pmv = px.bar(
-        df_pmv_ordenado, 
-        x='PRECO_MEDIO_CALCULADO', 
-        y='PRODUTO_COMPLETO', 
+        df_pmv_ordenado,
+        x='PRECO_MEDIO_CALCULADO',
+        y='PRODUTO_COMPLETO',
         orientation='h',
         title="8. Preço Médio Calculado (R$/Kg) - Top 15 Produtos",
         labels={'PRODUTO_COMPLETO': 'Produto', 'PRECO_MEDIO_CALCULADO': 'Preço Médio (R$/Kg)'},
         text='PRECO_MEDIO_CALCULADO'  # Define a coluna que será usada como texto
     )
-    
+
     # 1. Formata os rótulos de texto na barra para aparecer como R$ X,XX
     fig_pmv.update_traces(
-        # textposition='auto', # Garante que o texto se ajuste automaticamente
         texttemplate='R$ %{text:.2f}', # Adiciona R$ e limita a 2 casas decimais
         insidetextanchor='start', # Coloca o texto no início da barra
         textfont_size=12 # Opcional: Ajusta o tamanho da fonte
     )
-    
+
     # 2. Formata o eixo X como moeda (R$)
     fig_pmv.update_xaxes(tickprefix='R$ ')
+    medir_grafico(graficos, 'preco_medio', inicio, fig_pmv)
+
+    return graficos
+
+
+@st.cache_resource(max_entries=32)
+def montar_graficos_precos(versao, filtros):
+    """Constrói (e mede) as figuras da análise de preços (gráficos 10 e 11)."""
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    precos = calcular_precos(versao, filtros)
+    rotulos = rotulos_busca(versao, 'PRODUTO')
+    graficos = {}
+
+    # --- GRÁFICO 10: Distribuição de preço dos 15 produtos de maior faturamento ---
+    # Caixas montadas direto dos quantis dos esboços (bigodes em P05 e P95, losango no preço médio)
+    inicio = time.perf_counter()
+    top_15 = precos['resumo'].head(15).iloc[::-1]
+    nomes = [rotulos.get(produto, str(produto)) for produto in top_15['PRODUTO']]
+    fig_distribuicao = go.Figure(go.Box(
+        y=nomes,
+        q1=top_15['P25'].round(2), median=top_15['P50'].round(2), q3=top_15['P75'].round(2),
+        lowerfence=top_15['P05'].round(2), upperfence=top_15['P95'].round(2),
+        mean=top_15['PRECO_MEDIO_CALCULADO'].round(2),
+        orientation='h',
+        name='Preço (R$/Kg)',
+    ))
+    fig_distribuicao.update_layout(title="10. Distribuição de Preço (R$/Kg) - Top 15 Produtos", showlegend=False)
+    fig_distribuicao.update_xaxes(tickprefix='R$ ')
+    medir_grafico(graficos, 'distribuicao_precos', inicio, fig_distribuicao)
+
+    # --- GRÁFICO 11: Preço mediano mês a mês dos 10 produtos de maior faturamento ---
+    inicio = time.perf_counter()
+    top_10 = precos['resumo']['PRODUTO'].head(10)
+    df_mensal = precos['mensal'][precos['mensal']['PRODUTO'].isin(top_10)].assign(
+        P50=lambda d: d['P50'].round(2)
+    )
+    fig_mensal = px.line(
+        df_mensal,
+        x='DATA_REF',
+        y='P50',
+        color='PRODUTO',
+        title="11. Preço Mediano Mensal (R$/Kg) - Top 10 Produtos",
+        labels={'DATA_REF': 'Data', 'P50': 'Preço Mediano (R$/Kg)', 'PRODUTO': 'Produto'},
+        markers=True,
+    )
+    fig_mensal.update_yaxes(tickprefix='R$ ')
+    medir_grafico(graficos, 'precos_mensais', inicio, fig_mensal)
+
+    return graficos
+
+
+# --- Telemetria de Uso e Pré-aquecimento ---
+# Cada seção aberta registra, de forma anônima (sem IP, usuário ou sessão), apenas a
+# assinatura dos filtros e os parâmetros da seção. Depois de cada atualização dos dados, uma
+# thread em segundo plano recalcula as PREAQUECER_TOP_K combinações mais frequentes, para
+# que os primeiros acessos à nova versão já encontrem os resultados em cache.
+# As contagens são persistidas em USO_FILE e reduzidas pela metade a cada atualização,
+# de modo que seleções que deixaram de ser usadas saem do topo com o tempo.
+USO_FILE = os.environ.get('DASHBOARD_USO_FILE', 'uso_filtros.json')
+PREAQUECER_TOP_K = int(os.environ.get('DASHBOARD_PREAQUECER_TOP_K', 8))
+MAX_COMBINACOES_USO = 500  # Combinações guardadas em USO_FILE (as mais frequentes)
+GRAVAR_USO_A_CADA = 50  # Registros de uso entre duas gravações de USO_FILE
+
+
+def _uso_para_json(valor):
+    """Converte os argumentos de uma seção (tuplas, datas) em JSON."""
+    if isinstance(valor, tuple):
+        return [_uso_para_json(v) for v in valor]
+    if isinstance(valor, pd.Timestamp):
+        return {'timestamp': valor.isoformat()}
+    if hasattr(valor, 'item'):  # Escalares numpy
+        return valor.item()
+    return valor
+
+
+def _uso_de_json(valor):
+    """Inverso de _uso_para_json."""
+    if isinstance(valor, list):
+        return tuple(_uso_de_json(v) for v in valor)
+    if isinstance(valor, dict):
+        return pd.Timestamp(valor['timestamp'])
+    return valor
+
+
+def carregar_uso():
+    """Carrega as contagens de uso de USO_FILE ({(secao, argumentos): contagem})."""
+    try:
+        with open(USO_FILE, 'r', encoding='utf-8') as f:
+            return {(item['secao'], _uso_de_json(item['args'])): item['contagem'] for item in json.load(f)}
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        return {}
 
-    #st.plotly_chart(fig_pmv, width='stretch', config={})
-    st.plotly_chart(fig_pmv, config={})
-
-    # --- Tabela de Clientes Inativos (Análise de Churn/Risco) ---
-st.markdown("---")
-st.subheader("Análise de Clientes Inativos (Risco de Churn)")
-
-# --- Lógica de Data Dinâmica ---
-data_hoje = datetime.datetime.now()
-DATA_LIMITE = pd.to_datetime(data_hoje.strftime('%Y-%m-01'))
-mes_referencia = data_hoje.strftime('%B %Y').capitalize() 
 
-st.caption(f"Clientes cuja última compra foi **anterior** ao mês de referência: {mes_referencia} (Baseado nos filtros aplicados).")
+def salvar_uso(contagem):
+    """Grava as combinações mais frequentes em USO_FILE. Falhas apenas geram log."""
+    populares = sorted(contagem.items(), key=lambda item: item[1], reverse=True)[:MAX_COMBINACOES_USO]
+    try:
+        with open(USO_FILE + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(
+                [{'secao': secao, 'args': _uso_para_json(args), 'contagem': n} for (secao, args), n in populares],
+                f, ensure_ascii=False
+            )
+        os.replace(USO_FILE + '.tmp', USO_FILE)
+    except Exception as e:
+        logger.warning(f"Não foi possível gravar a telemetria de uso: {e}")
 
-# 1. Fonte de dados: Usamos o DF FILTRADO para refletir as seleções do usuário
-# Isso garante que se o usuário filtrar por CE, só veremos clientes de CE.
-df_base_tabela = df_filtrado.copy()
 
-# 2. Encontrar a data da última compra (DATA_REF) para cada cliente
-# A última compra é determinada DENTRO DO CONJUNTO DE DADOS FILTRADO
-df_ultima_compra = df_base_tabela.groupby('NOME')['DATA_REF'].max().reset_index()
-df_ultima_compra.rename(columns={'DATA_REF': 'DATA_ULTIMA_COMPRA'}, inplace=True)
+@st.cache_resource
+def telemetria_uso():
+    """Contagens de uso compartilhadas por todas as sessões do processo."""
+    return {'contagem': carregar_uso(), 'lock': threading.Lock(), 'pendentes': 0, 'preaquecidas': set()}
 
-# 3. Filtrar inativos: Última compra anterior ao mês de referência (DINÂMICO)
-df_inativos = df_ultima_compra[df_ultima_compra['DATA_ULTIMA_COMPRA'] < DATA_LIMITE]
 
-if not df_inativos.empty:
-    
-    # 4. Trazer o nome do Representante e UF
-    # Usamos o df_filtrado (que já está reduzido) para pegar as colunas, eliminando duplicatas
-    df_caracteristicas = df_filtrado[['NOME', 'REPRESENTANTE', 'UF']].drop_duplicates(subset=['NOME'])
-    
-    df_tabela_inativos = pd.merge(
-        df_inativos, 
-        df_caracteristicas, 
-        on='NOME', 
-        how='left'
+def registrar_uso(secao, *args):
+    """
+    Conta um acesso à `secao` com os argumentos (após a versão) da sua função de cálculo.
+    Cada sessão conta cada combinação uma única vez, por mais que a página seja reexecutada.
+    """
+    chave = (secao, args)
+    ja_registradas = st.session_state.setdefault('uso_registrado', set())
+    if chave in ja_registradas:
+        return
+    ja_registradas.add(chave)
+    telemetria = telemetria_uso()
+    with telemetria['lock']:
+        telemetria['contagem'][chave] = telemetria['contagem'].get(chave, 0) + 1
+        telemetria['pendentes'] += 1
+        if telemetria['pendentes'] < GRAVAR_USO_A_CADA:
+            return
+        telemetria['pendentes'] = 0
+        contagem = dict(telemetria['contagem'])
+    salvar_uso(contagem)
+
+
+def preaquecer_populares(versao):
+    """Calcula, para a versão informada, as combinações (seção, argumentos) mais usadas."""
+    # Funções de cálculo de cada seção (as mesmas chamadas pelas funções exibir_*)
+    calculos = {
+        'kpis': calcular_kpis,
+        'graficos': montar_graficos,
+        'produtos': montar_graficos_produtos,
+        'precos': montar_graficos_precos,
+        'inativos': calcular_inativos,
+        'queda': calcular_queda,
+    }
+    telemetria = telemetria_uso()
+    with telemetria['lock']:
+        contagem = telemetria['contagem']
+        populares = sorted(contagem, key=contagem.get, reverse=True)[:PREAQUECER_TOP_K]
+        # Decaimento: uma atualização de dados reduz o peso dos acessos anteriores à metade
+        for chave in list(contagem):
+            contagem[chave] /= 2
+            if contagem[chave] < 0.5:
+                del contagem[chave]
+        copia = dict(contagem)
+    salvar_uso(copia)
+
+    inicio = time.perf_counter()
+    for secao, args in populares:
+        try:
+            calculos[secao](versao, *args)
+        except Exception as e:
+            logger.warning(f"Pré-aquecimento de '{secao}' falhou: {e}")
+    logger.info(
+        f"Pré-aquecimento da versão {versao[:8]}: {len(populares)} combinações "
+        f"em {time.perf_counter() - inicio:.2f}s"
     )
-    
-    # 5. Cria a coluna 'Mês da Última Compra' formatada para exibição
-    df_tabela_inativos['MÊS_ULTIMA_COMPRA'] = df_tabela_inativos['DATA_ULTIMA_COMPRA'].dt.strftime('%b/%Y')
 
-    # 6. Ordenar: DATA_ULTIMA_COMPRA (desc.) e REPRESENTANTE (cresc.)
-    df_tabela_inativos.sort_values(
-        by=['DATA_ULTIMA_COMPRA', 'REPRESENTANTE'], 
-        ascending=[False, True], 
-        inplace=True
-    )
 
-    # 7. Selecionar e Renomear colunas
-    df_final_inativos = df_tabela_inativos[[
-        'NOME', 
-        'REPRESENTANTE', 
-        'UF', # NOVO: Incluí a UF na tabela para facilitar a análise com o filtro
-        'MÊS_ULTIMA_COMPRA'
-    ]].rename(columns={
-        'NOME': 'Nome do Cliente',
-        'REPRESENTANTE': 'Representante',
-        'UF': 'UF',
-        'MÊS_ULTIMA_COMPRA': 'Mês da Última Compra'
-    })
+def agendar_preaquecimento(versao):
+    """Dispara (uma vez por versão) o pré-aquecimento em segundo plano."""
+    telemetria = telemetria_uso()
+    with telemetria['lock']:
+        if versao in telemetria['preaquecidas']:
+            return
+        telemetria['preaquecidas'].add(versao)
+    threading.Thread(
+        target=preaquecer_populares,
+        args=(versao,),
+        name='preaquecimento',
+        daemon=True,
+    ).start()
 
-    # 8. Exibir a Tabela
-    st.dataframe(
-        df_final_inativos,
-        width='stretch',
-        hide_index=True 
-    )
 
-else:
-    # Mostra a mensagem de sucesso se não houver inativos dentro do conjunto filtrado
-    st.success(f"🎉 Não há clientes inativos no conjunto de dados filtrado para o mês de {mes_referencia}!")
+# =====================================================================================
+# --- EXIBIÇÃO DAS SEÇÕES ---
+# =====================================================================================
 
+def exibir_kpis(versao, filtros):
+    """--- Exibir KPIs (Indicadores-Chave) ---"""
+    st.subheader("Indicadores-Chave de Performance")
 
+    registrar_uso('kpis', filtros)
+    kpis = calcular_kpis(versao, filtros)
 
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Venda Total (R$)", formatar_br(kpis['total_rs']))
+    col2.metric("Volume Total (Kg)", f"{formatar_br(kpis['total_kg'], is_currency=False)} Kg")
+    col3.metric("Clientes Únicos", f"{kpis['clientes_unicos']}")
 
-# --- Tabela 9: Análise de Queda (Período 1 vs. Período 2) ---
-st.markdown("---")
-st.subheader("9. Análise de Queda Comparativa (Período 1 vs. Período 2)")
+    col4, col5, col6 = st.columns(3)
+    col4.metric("Preço Médio (R$/Kg)", formatar_br(kpis['preco_medio']))
+    col5.metric("Bonificação (Kg)", f"{formatar_br(kpis['total_bonif_kg'], is_currency=False)} Kg")
+    col6.metric("Taxa de Bonificação (%)", f"{formatar_br(kpis['taxa_bonif'], is_currency=False)}%")
 
-# --- NOVO: Seletor de Métrica (R$ ou KG) ---
-# Usamos colunas para posicionar o seletor acima da tabela, mas na mesma seção
-col_info, col_seletor = st.columns([2, 1])
+    payload = {}
+    exibir_grafico(montar_graficos_kpis(versao, filtros), 'clientes_ativos', payload)
+    exibir_orcamento_payload(payload)
 
-with col_seletor:
-    metrica_selecionada = st.radio(
-        "Métrica de Análise:",
-        options=['Volume (KG)', 'Vendas (R$)'],
-        index=0, # Inicia em KG por padrão
-        key='tabela9_metrica'
-    )
 
-    
+def exibir_graficos(versao, filtros):
+    """--- GRÁFICOS 1 a 6 ---"""
+    st.subheader("Análises Gráficas")
 
-# Define a coluna de dados e o formato com base na seleção
-if 'KG' in metrica_selecionada:
-    COLUNA_DADOS = 'FATURA_KG'
-    SUFIXO_COLUNA = '(KG)'
-    FORMATO_NUMERICO = ',.2f'
-    LABEL_METRICA = 'Volume'
-else:
-    COLUNA_DADOS = 'FATURA_RS'
-    SUFIXO_COLUNA = '(R$)'
-    FORMATO_NUMERICO = ',.2f' # Formato que será corrigido para BR no Pandas
-    LABEL_METRICA = 'Venda'
-    
+    registrar_uso('graficos', filtros)
+    graficos = montar_graficos(versao, filtros)
+    payload = {}
 
-# Leitura dos filtros de Mês e Ano
-meses_filtrados = st.session_state.get('filter_MÊS', [])
-anos_filtrados = st.session_state.get('filter_ANO', [])
+    col_graf1, col_graf2 = st.columns(2)
+    col_graf3, col_graf4 = st.columns(2)
 
-# 1. Criar a lista completa de PERÍODOS (Mês/Ano)
-periodos_completos = []
-mes_map_ordem = {
-    'janeiro': 1, 'fevereiro': 2, 'março': 3, 'abril': 4, 'maio': 5, 'junho': 6,
-    'julho': 7, 'agosto': 8, 'setembro': 9, 'outubro': 10, 'novembro': 11, 'dezembro': 12
-}
+    with col_graf1:
+        exibir_grafico(graficos, 'evolucao', payload)
+    with col_graf2:
+        exibir_grafico(graficos, 'yoy', payload)
+    with col_graf3:
+        exibir_grafico(graficos, 'top_reps', payload)
+    with col_graf4:
+        exibir_grafico(graficos, 'top_clientes', payload)
 
-for ano_sel in sorted(anos_filtrados):
-    for mes_sel in sorted(meses_filtrados, key=lambda m: mes_map_ordem.get(m.lower().strip(), 0)):
-        periodos_completos.append((ano_sel, mes_sel))
+    col_graf5, col_graf6 = st.columns(2)
 
+    with col_graf5:
+        exibir_grafico(graficos, 'familia', payload)
+    with col_graf6:
+        exibir_grafico(graficos, 'uf', payload)
 
-# 2. Verificar se o número de períodos é par
-num_periodos = len(periodos_completos)
-df_final = pd.DataFrame()
+    exibir_orcamento_payload(payload)
 
-if not df_filtrado.empty and num_periodos > 0 and num_periodos % 2 == 0:
-    
-    meio = num_periodos // 2
-    periodo_1_list = periodos_completos[:meio]
-    periodo_2_list = periodos_completos[meio:]
-    
-    periodo_1_str = ", ".join([f"{m}/{a}" for a, m in periodo_1_list])
-    periodo_2_str = ", ".join([f"{m}/{a}" for a, m in periodo_2_list])
-    
-    with col_info:
-        st.markdown(f"""
-        **Grupos de Comparação (dentro dos filtros aplicados):**
-        * **Período 1:** {periodo_1_str}
-        * **Período 2:** {periodo_2_str}
-        """)
-    
-    # 3. BASE DE DADOS: Usamos o DF FILTRADO
-    df_comparacao = df_filtrado.copy()
 
-    df_comparacao['IS_P1'] = df_comparacao.apply(
-        lambda row: (row['ANO'], row['MÊS']) in periodo_1_list, axis=1
-    )
-    df_comparacao['IS_P2'] = df_comparacao.apply(
-        lambda row: (row['ANO'], row['MÊS']) in periodo_2_list, axis=1
-    )
+def exibir_produtos(versao, filtros):
+    """--- Análise de Produtos: Gráfico 7 (Pizza) e Gráfico 8 (Preço Médio) ---"""
+    st.subheader("Análise de Produtos")
 
-    # 5. Agrupar os valores por cliente e por período (usando a COLUNA_DADOS DINÂMICA)
-    
-    df_p1 = df_comparacao[df_comparacao['IS_P1']].groupby('NOME')[COLUNA_DADOS].sum().reset_index()
-    df_p1.rename(columns={COLUNA_DADOS: 'P1_VALOR'}, inplace=True)
-    
-    df_p2 = df_comparacao[df_comparacao['IS_P2']].groupby('NOME')[COLUNA_DADOS].sum().reset_index()
-    df_p2.rename(columns={COLUNA_DADOS: 'P2_VALOR'}, inplace=True)
+    registrar_uso('produtos', filtros)
+    graficos = montar_graficos_produtos(versao, filtros)
+    payload = {}
 
-    # 6. Merge dos Volumes e Cálculo da Queda/Crescimento
-    df_resultado = pd.merge(df_p1, df_p2, on='NOME', how='outer').fillna(0)
-    
-    df_resultado['QUEDA_VALOR'] = df_resultado['P1_VALOR'] - df_resultado['P2_VALOR']
+    # Criação das colunas para os gráficos 7 e 8
+    col_graf7, col_graf8 = st.columns(2)
 
-    # 7. Filtrar apenas as Quedas (QUEDA_VALOR > 0)
-    df_queda = df_resultado[df_resultado['QUEDA_VALOR'] > 0].copy()
+    with col_graf7:
+        exibir_grafico(graficos, 'top_produtos', payload)
+    with col_graf8:
+        exibir_grafico(graficos, 'preco_medio', payload)
 
-    if not df_queda.empty:
-        
-        # 8. Trazer a UF
-        df_caracteristicas = df_filtrado[['NOME', 'UF']].drop_duplicates(subset=['NOME'])
-        df_final = pd.merge(df_queda, df_caracteristicas, on='NOME', how='left')
-        
-        # 9. Ordenar pela maior queda
-        df_final.sort_values(by='QUEDA_VALOR', ascending=False, inplace=True)
-        
-        # 10. Selecionar e Renomear Colunas
-        df_final = df_final[[
-            'NOME', 
-            'UF', 
-            'P1_VALOR', 
-            'P2_VALOR', 
-            'QUEDA_VALOR'
-        ]].rename(columns={
-            'NOME': 'Nome do Cliente',
-            'UF': 'UF',
-            'P1_VALOR': f'{LABEL_METRICA} (Período 1) {SUFIXO_COLUNA}',
-            'P2_VALOR': f'{LABEL_METRICA} (Período 2) {SUFIXO_COLUNA}',
-            'QUEDA_VALOR': f'Queda no {LABEL_METRICA} {SUFIXO_COLUNA}'
-        })
-
-        # --- Tabela 9: Análise de Queda Comparativa ---
-
-# --- Tabela 9: Análise de Queda Comparativa (FINAL) ---
-
-# 10.5. PREPARAÇÃO DOS DATAFRAMES
-df_final_raw = df_final.copy() 
-
-# df_display contém as colunas formatadas como strings para exibição
-df_display = df_final.copy()
-colunas_a_formatar = [col for col in df_display.columns if 'Período' in col or 'Queda' in col]
-
-for col in colunas_a_formatar:
-    df_display[col] = df_display[col].map(
-        lambda x: f'{x:{FORMATO_NUMERICO}}'.replace(',', 'X').replace('.', ',').replace('X', '.')
-    )
+    exibir_orcamento_payload(payload)
 
-# 11. INICIALIZAÇÃO DE OBSERVAÇÕES E ESTADO
-observacoes = carregar_observacoes()
-df_final_raw['idx_posicao'] = range(len(df_final_raw)) # Índice de posição
-df_display['idx_posicao'] = range(len(df_display)) # Índice de posição
 
-if 'cliente_aberto' not in st.session_state:
-    st.session_state['cliente_aberto'] = None
+def exibir_precos(versao, filtros):
+    """--- Análise de Preços: Gráficos 10 e 11 e tabelas de distribuição e variação ---"""
+    st.subheader("Análise de Preços por Produto")
+    st.caption(
+        "Distribuição do preço (PRECO_MEDIO) das notas de cada produto, estimada a partir de "
+        "esboços por produto e mês (quantis com erro de ~1%). Outliers: notas fora de "
+        "P25 − 1,5·IQR e P75 + 1,5·IQR."
+    )
 
-# --- DEFINIÇÃO DO LAYOUT ---
-#st.subheader("9. Análise de Queda Comparativa (Período 1 vs. Período 2)")
+    registrar_uso('precos', filtros)
+    precos = calcular_precos(versao, filtros)
+    if precos['resumo'].empty or precos['mensal'].empty:
+        # Ex.: apenas linhas de bonificação (PRECO_MEDIO zerado) no conjunto filtrado
+        st.info("Não há notas com preço (PRECO_MEDIO maior que zero) no conjunto filtrado.")
+        return
+
+    graficos = montar_graficos_precos(versao, filtros)
+    payload = {}
+    rotulos = rotulos_busca(versao, 'PRODUTO')
+
+    col_graf10, col_graf11 = st.columns(2)
+
+    with col_graf10:
+        exibir_grafico(graficos, 'distribuicao_precos', payload)
+    with col_graf11:
+        exibir_grafico(graficos, 'precos_mensais', payload)
+
+    st.markdown("**Distribuição de preço por produto**")
+    colunas_resumo = {
+        'PRODUTO': 'Produto', 'FATURA_RS': 'Faturamento (R$)', 'FATURA_KG': 'Volume (Kg)',
+        'PRECO_MEDIO_CALCULADO': 'Preço Médio (R$/Kg)', 'P05': 'P05', 'P25': 'P25', 'P50': 'Mediana',
+        'P75': 'P75', 'P95': 'P95', 'DISPERSAO': 'Dispersão IQR (%)', 'LINHAS': 'Notas', 'OUTLIERS': 'Outliers',
+    }
+    df_resumo = precos['resumo'][list(colunas_resumo)].rename(columns=colunas_resumo)
+    df_resumo['Produto'] = df_resumo['Produto'].map(lambda produto: rotulos.get(produto, str(produto)))
+    st.dataframe(
+        df_resumo,
+        width='stretch',
+        hide_index=True,
+        column_config={col: FORMATO_NUMERO_TABELA for col in list(colunas_resumo.values())[1:10]}
+    )
 
-# Larguras das colunas: [Botão, Ícone, Cliente, UF, Período 1, Período 2, Queda]
-colunas_widths = [0.4, 0.4, 3, 1, 1.5, 1.5, 1.5] 
-colunas_nomes = ['Abrir', 'Obs', 'Cliente', 'UF', 'Período 1 (R$)', 'Período 2 (R$)', 'Queda (R$)']
+    # Variação do último mês do filtro sobre o mês anterior com vendas de cada produto
+    mensal = precos['mensal']
+    ultimo_mes = mensal['DATA_REF'].max()
+    df_variacao = mensal[(mensal['DATA_REF'] == ultimo_mes) & mensal['VARIACAO'].notna()]
+    st.markdown(f"**Variação do preço mediano: {rotulo_mes(ultimo_mes)} vs. mês anterior**")
+    if df_variacao.empty:
+        st.info("Não há dois meses com vendas do mesmo produto no conjunto filtrado para comparar.")
+    else:
+        df_variacao = df_variacao.reindex(df_variacao['VARIACAO'].abs().sort_values(ascending=False).index)
+        st.dataframe(
+            pd.DataFrame({
+                'Produto': df_variacao['PRODUTO'].map(lambda produto: rotulos.get(produto, str(produto))),
+                'Mediana Anterior (R$/Kg)': df_variacao['P50_ANTERIOR'],
+                'Mediana Atual (R$/Kg)': df_variacao['P50'],
+                'Variação (%)': df_variacao['VARIACAO'],
+            }),
+            width='stretch',
+            hide_index=True,
+            column_config={
+                col: FORMATO_NUMERO_TABELA
+                for col in ['Mediana Anterior (R$/Kg)', 'Mediana Atual (R$/Kg)', 'Variação (%)']
+            }
+        )
+
+    exibir_orcamento_payload(payload)
+
+
+def exibir_inativos(versao, filtros):
+    """--- Tabela de Clientes Inativos (Análise de Churn/Risco) ---"""
+    st.subheader("Análise de Clientes Inativos (Risco de Churn)")
+
+    # --- Lógica de Data Dinâmica ---
+    data_hoje = datetime.datetime.now()
+    DATA_LIMITE = pd.to_datetime(data_hoje.strftime('%Y-%m-01'))
+    mes_referencia = f"{MESES_PT[data_hoje.month - 1]} {data_hoje.year}".capitalize()
+
+    st.caption(f"Clientes cuja última compra foi **anterior** ao mês de referência: {mes_referencia} (Baseado nos filtros aplicados).")
+
+    registrar_uso('inativos', filtros, DATA_LIMITE)
+    df_final_inativos = calcular_inativos(versao, filtros, DATA_LIMITE)
+
+    if not df_final_inativos.empty:
+        st.dataframe(
+            df_final_inativos,
+            width='stretch',
+            hide_index=True
+        )
+    else:
+        # Mostra a mensagem de sucesso se não houver inativos dentro do conjunto filtrado
+        st.success(f"🎉 Não há clientes inativos no conjunto de dados filtrado para o mês de {mes_referencia}!")
+
+
+def exibir_analise_queda(versao, filtros):
+    """--- Tabela 9: Análise de Queda (Período 1 vs. Período 2) ---"""
+    st.subheader("9. Análise de Queda Comparativa (Período 1 vs. Período 2)")
+
+    # --- Seletor de Métrica (R$ ou KG) ---
+    # Usamos colunas para posicionar o seletor acima da tabela, mas na mesma seção
+    col_info, col_seletor = st.columns([2, 1])
+
+    with col_seletor:
+        metrica_selecionada = st.radio(
+            "Métrica de Análise:",
+            options=['Volume (KG)', 'Vendas (R$)'],
+            index=0, # Inicia em KG por padrão
+            key='tabela9_metrica'
+        )
+
+    # Define a coluna de dados e o formato com base na seleção
+    if 'KG' in metrica_selecionada:
+        COLUNA_DADOS = 'FATURA_KG'
+        SUFIXO_COLUNA = '(KG)'
+        LABEL_METRICA = 'Volume'
+    else:
+        COLUNA_DADOS = 'FATURA_RS'
+        SUFIXO_COLUNA = '(R$)'
+        LABEL_METRICA = 'Venda'
+
+    # Leitura dos filtros de Mês e Ano
+    meses_filtrados = st.session_state.get('filter_MÊS', [])
+    anos_filtrados = st.session_state.get('filter_ANO', [])
+
+    # 1. Criar a lista completa de PERÍODOS (Mês/Ano)
+    periodos_completos = periodos_tabela9(anos_filtrados, meses_filtrados, filtros)
+
+    # 2. Verificar se o número de períodos é par
+    num_periodos = len(periodos_completos)
+    df_final = pd.DataFrame()
+
+    if num_periodos > 0 and num_periodos % 2 == 0:
+
+        meio = num_periodos // 2
+        periodo_1_list = tuple(periodos_completos[:meio])
+        periodo_2_list = tuple(periodos_completos[meio:])
+
+        periodo_1_str = ", ".join([f"{m}/{a}" for a, m in periodo_1_list])
+        periodo_2_str = ", ".join([f"{m}/{a}" for a, m in periodo_2_list])
+
+        with col_info:
+            st.markdown(f"""
+            **Grupos de Comparação (dentro dos filtros aplicados):**
+            * **Período 1:** {periodo_1_str}
+            * **Período 2:** {periodo_2_str}
+            """)
+
+        registrar_uso('queda', filtros, COLUNA_DADOS, periodo_1_list, periodo_2_list, LABEL_METRICA, SUFIXO_COLUNA)
+        df_final = calcular_queda(versao, filtros, COLUNA_DADOS, periodo_1_list, periodo_2_list, LABEL_METRICA, SUFIXO_COLUNA)
+
+    # --- Tabela 9: Análise de Queda Comparativa (FINAL) ---
+
+    # 10.5. PREPARAÇÃO DAS COLUNAS FORMATADAS
+    # df_final mantém os valores numéricos (ordenação e exportação); os textos pt-BR são
+    # gerados uma vez por coluna e lidos por posição na renderização linha a linha.
+    colunas_valores = [
+        f'{LABEL_METRICA} (Período 1) {SUFIXO_COLUNA}',
+        f'{LABEL_METRICA} (Período 2) {SUFIXO_COLUNA}',
+        f'Queda no {LABEL_METRICA} {SUFIXO_COLUNA}',
+    ]
+    textos_valores = [
+        formatar_br_serie(df_final[col]).tolist() if col in df_final.columns else ['N/D'] * len(df_final)
+        for col in colunas_valores
+    ]
+
+    # 11. INICIALIZAÇÃO DE OBSERVAÇÕES E ESTADO
+    observacoes = carregar_observacoes()
+
+    if 'cliente_aberto' not in st.session_state:
+        st.session_state['cliente_aberto'] = None
+
+    # --- DEFINIÇÃO DO LAYOUT ---
+    # Larguras das colunas: [Botão, Ícone, Cliente, UF, Período 1, Período 2, Queda]
+    colunas_widths = [0.4, 0.4, 3, 1, 1.5, 1.5, 1.5]
+    colunas_nomes = ['Abrir', 'Obs', 'Cliente', 'UF', 'Período 1 (R$)', 'Período 2 (R$)', 'Queda (R$)']
+
+    # 1. EXIBIR CABEÇALHO (FIXO)
+    cols_header = st.columns(colunas_widths)
+    for col_name, col_obj in zip(colunas_nomes, cols_header):
+        # Usamos st.markdown para reduzir o espaçamento
+        col_obj.markdown(f"**{col_name}**")
+
+    # --- INÍCIO DO CONTAINER COM BARRA DE ROLAGEM (ALTURA FIXA) ---
+    with st.container(height=400, border=True):
+
+        # 2. Renderização Linha por Linha
+        linhas = zip(
+            df_final.index,
+            df_final.get('Nome do Cliente', []),
+            df_final.get('UF', []),
+            *textos_valores
+        )
+        for index, cliente, uf, texto_p1, texto_p2, texto_queda in linhas:
+
+            obs_icon = '📝' if cliente in observacoes else ''
+
+            # Cria as colunas para a linha de dados
+            cols = st.columns(colunas_widths)
+
+            # Coluna 1: O PEQUENO BOTÃO
+            with cols[0]:
+                # Usamos o emoji no botão e key única
+                if st.button("✏️", key=f"btn_open_{index}"):
+                    st.session_state['cliente_aberto'] = cliente
+                    st.rerun()
+
+            # Colunas 2 a 7: Dados
+            cols[1].markdown(obs_icon)
+            cols[2].markdown(cliente)
+            cols[3].markdown(uf)
+            cols[4].markdown(texto_p1)
+            cols[5].markdown(texto_p2)
+            cols[6].markdown(texto_queda)
+
+    # --- FIM DO CONTAINER ---
+
+    # --- 3. LÓGICA DE EDIÇÃO (FORA DO CONTAINER) ---
+    # O Textarea aparecerá logo abaixo da tabela.
+
+    cliente_aberto = st.session_state.get('cliente_aberto')
+
+    if cliente_aberto:
+
+        st.markdown("---")
+        st.subheader(f"✏️ Observação para: **{cliente_aberto}**")
+
+        obs_existente = observacoes.get(cliente_aberto, "")
+
+        # Textarea para observação
+        nova_observacao = st.text_area(
+            "Insira sua observação aqui:",
+            value=obs_existente,
+            height=150,
+            key=f"obs_text_area_{cliente_aberto}"
+        )
+
+        col_salvar, col_cancelar, col_fechar = st.columns([1, 1, 4])
+
+        with col_salvar:
+            if st.button("💾 Salvar", key="btn_save_final", type="primary"):
+                if nova_observacao.strip():
+                    observacoes[cliente_aberto] = nova_observacao.strip()
+                elif cliente_aberto in observacoes:
+                    del observacoes[cliente_aberto]
+
+                salvar_observacoes(observacoes)
+                st.session_state['cliente_aberto'] = None # Fecha a área
+                st.toast("Observação salva! Recarregando...", icon='📝')
+                st.rerun()
 
-# 1. EXIBIR CABEÇALHO (FIXO)
-cols_header = st.columns(colunas_widths)
-for col_name, col_obj in zip(colunas_nomes, cols_header):
-    # Usamos st.markdown para reduzir o espaçamento
-    col_obj.markdown(f"**{col_name}**")
-#st.markdown("---") 
+        with col_cancelar:
+            if st.button("❌ Cancelar", key="btn_cancel_final"):
+                st.info("Edição cancelada.")
+                st.session_state['cliente_aberto'] = None # Fecha a área
+                st.rerun()
 
-# --- INÍCIO DO CONTAINER COM BARRA DE ROLAGEM (ALTURA FIXA) ---
-with st.container(height=400, border=True): 
-    
-    # 2. Renderização Linha por Linha
-    for index, row in df_final_raw.iterrows():
-        
-        cliente = row['Nome do Cliente']
-        obs_icon = '📝' if cliente in observacoes else ''
-        
-        # Cria as colunas para a linha de dados
-        cols = st.columns(colunas_widths)
-        
-        # Coluna 1: O PEQUENO BOTÃO
-        with cols[0]:
-            # Usamos o emoji no botão e key única
-            if st.button("✏️", key=f"btn_open_{index}"):
-                st.session_state['cliente_aberto'] = cliente
+        with col_fechar:
+            if st.button("Fechar Área", key="btn_close_final"):
+                st.session_state['cliente_aberto'] = None # Fecha a área
                 st.rerun()
 
-        # Obter a linha formatada para exibição (usamos o índice de posição)
-        display_row = df_display.iloc[row['idx_posicao']]
-        
-        # Colunas 2 a 7: Dados
-        cols[1].markdown(obs_icon)
-        cols[2].markdown(cliente)
-        cols[3].markdown(row['UF'])
-        cols[4].markdown(display_row.get(f'{LABEL_METRICA} (Período 1) {SUFIXO_COLUNA}', 'N/D'))
-        cols[5].markdown(display_row.get(f'{LABEL_METRICA} (Período 2) {SUFIXO_COLUNA}', 'N/D'))
-        cols[6].markdown(display_row.get(f'Queda no {LABEL_METRICA} {SUFIXO_COLUNA}', 'N/D'))
+    # 4. Lógica da Mensagem Final
+    elif df_final.empty:
+        st.success(f"Nenhum cliente no conjunto filtrado teve queda no {LABEL_METRICA}...")
 
-# --- FIM DO CONTAINER ---
+    else:
+        # Aviso de número ímpar ou sem dados
+        if num_periodos % 2 != 0:
+            st.warning("Selecione um número **PAR** de meses/anos para que a comparação entre Períodos 1 e 2 possa ser feita.")
+        else:
+            st.warning("Por favor, selecione meses e anos nos filtros laterais para iniciar a análise comparativa.")
+        st.info(f"Períodos detectados: {num_periodos}")
+        excel_data = exportar_queda_excel(versao, filtros, COLUNA_DADOS, periodo_1_list, periodo_2_list, LABEL_METRICA, SUFIXO_COLUNA)
+
+        st.download_button(
+            label="Exportar para Excel 📊",
+            data=excel_data,
+            file_name='Analise_Queda_Clientes.xlsx',
+            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            type="primary"
+        )
+
+
+# --- Relatório completo (gerado em segundo plano) ---
+with st.sidebar:
+    painel_relatorio(VERSAO, filtros)
+
+
+# --- SEÇÕES EM ABAS (execução sob demanda) ---
+# Com on_change="rerun" o Streamlit informa qual aba está aberta (propriedade .open),
+# então apenas a seção visível é calculada e renderizada a cada execução.
+aba_kpis, aba_graficos, aba_produtos, aba_precos, aba_inativos, aba_queda = st.tabs(
+    ["📈 Indicadores", "📊 Gráficos", "📦 Produtos", "💲 Preços", "⚠️ Clientes Inativos", "📉 Análise de Queda"],
+    key='secao_ativa',
+    on_change='rerun'
+)
 
-# --- 3. LÓGICA DE EDIÇÃO (FORA DO CONTAINER) ---
-# O Textarea aparecerá logo abaixo da tabela.
+with aba_kpis:
+    if aba_kpis.open:
+        exibir_kpis(VERSAO, filtros)
 
-cliente_aberto = st.session_state.get('cliente_aberto')
+with aba_graficos:
+    if aba_graficos.open:
+        exibir_graficos(VERSAO, filtros)
 
-if cliente_aberto:
-    
-    st.markdown("---")
-    st.subheader(f"✏️ Observação para: **{cliente_aberto}**")
+with aba_produtos:
+    if aba_produtos.open:
+        exibir_produtos(VERSAO, filtros)
 
-    obs_existente = observacoes.get(cliente_aberto, "")
+with aba_precos:
+    if aba_precos.open:
+        exibir_precos(VERSAO, filtros)
 
-    # Textarea para observação
-    nova_observacao = st.text_area(
-        "Insira sua observação aqui:", 
-        value=obs_existente, 
-        height=150,
-        key=f"obs_text_area_{cliente_aberto}"
-    )
+with aba_inativos:
+    if aba_inativos.open:
+        exibir_inativos(VERSAO, filtros)
 
-    col_salvar, col_cancelar, col_fechar = st.columns([1, 1, 4])
-
-    with col_salvar:
-        if st.button("💾 Salvar", key="btn_save_final", type="primary"):
-            if nova_observacao.strip():
-                observacoes[cliente_aberto] = nova_observacao.strip()
-            elif cliente_aberto in observacoes:
-                del observacoes[cliente_aberto]
-                
-            salvar_observacoes(observacoes)
-            st.session_state['cliente_aberto'] = None # Fecha a área
-            st.toast("Observação salva! Recarregando...", icon='📝')
-            st.rerun() 
-
-    with col_cancelar:
-        if st.button("❌ Cancelar", key="btn_cancel_final"):
-            st.info("Edição cancelada.")
-            st.session_state['cliente_aberto'] = None # Fecha a área
-            st.rerun()
-
-    with col_fechar:
-        if st.button("Fechar Área", key="btn_close_final"):
-            st.session_state['cliente_aberto'] = None # Fecha a área
-            st.rerun() 
-            
-# 4. Lógica da Mensagem Final
-elif df_final.empty:
-    st.success(f"Nenhum cliente no conjunto filtrado teve queda no {LABEL_METRICA}...")
-
-else:
-    # Aviso de número ímpar ou sem dados
-    if df_filtrado.empty:
-        st.warning("Nenhum dado encontrado para os filtros selecionados.")
-    elif num_periodos % 2 != 0:
-        st.warning("Selecione um número **PAR** de meses/anos para que a comparação entre Períodos 1 e 2 possa ser feita.")
-    else:
-        st.warning("Por favor, selecione meses e anos nos filtros laterais para iniciar a análise comparativa.")
-    st.info(f"Períodos detectados: {num_periodos}")
-    excel_data = to_excel(df_final_raw)
-    
-    st.download_button(
-        label="Exportar para Excel 📊",
-        data=excel_data,
-        file_name='Analise_Queda_Clientes.xlsx',
-        mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        type="primary"
-    )
+with aba_queda:
+    if aba_queda.open:
+        exibir_analise_queda(VERSAO, filtros)
 
 # Opcional: Mostrar os dados filtrados em uma tabela
 if st.checkbox("Mostrar dados filtrados (Tabela)"):
 
-    st.dataframe(df_filtrado)   
-
+    st.dataframe(
+        filtrar_dados(VERSAO, filtros),
+        column_config={col: FORMATO_NUMERO_TABELA for col in ['FATURA_KG', 'FATURA_RS', 'PRECO_MEDIO', 'BONIF_KG']}
+    )
 
+# --- Pré-aquecimento das seleções mais usadas (uma vez por versão dos dados) ---
+agendar_preaquecimento(VERSAO)
 
+# --- Tempo até a primeira renderização do processo ---
+if 'primeira_renderizacao' not in relatorio_inicializacao():
+    registrar_marco('primeira_renderizacao', time.perf_counter() - _INICIO_EXECUCAO)
+    logger.info(f"Relatório de inicialização (s): {relatorio_inicializacao()}")